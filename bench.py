@@ -0,0 +1,211 @@
+import os, sys, json, time, argparse, tempfile, platform, subprocess
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+import numpy as np, pygame
+import main
+
+DENSITIES = {'light': 4, 'medium': 16, 'dense': 64, 'black': 400}
+LANE_KEYS = {lane: key for key, lane in main.KEYS.items()}
+
+def varlen(n):
+    out = [n & 0x7f]
+    n >>= 7
+    while n:
+        out.append(0x80 | (n & 0x7f))
+        n >>= 7
+    return bytes(reversed(out))
+
+def track_chunk(events):
+    data = bytearray()
+    last = 0
+    for tick, msg in events:
+        data += varlen(tick - last)
+        data += msg
+        last = tick
+    data += b'\x00\xff\x2f\x00'
+    return b'MTrk' + len(data).to_bytes(4, 'big') + bytes(data)
+
+def synth_midi(path, n_notes, nps, tracks=4, tempo_changes=8, seed=0):
+    rng = np.random.default_rng(seed)
+    tpb = 480
+    total = max(1, int(n_notes / nps * tpb * 2))
+    tempo_ticks = np.linspace(0, total, tempo_changes, endpoint=False).astype(int)
+    tempos = rng.integers(350000, 700000, tempo_changes)
+    chunks = [track_chunk([(int(t), b'\xff\x51\x03' + int(v).to_bytes(3, 'big'))
+                           for t, v in zip(tempo_ticks, tempos)])]
+    for i in range(tracks):
+        n = n_notes // tracks + (1 if i < n_notes % tracks else 0)
+        ticks = np.sort(rng.integers(0, total, n))
+        pitches = rng.integers(36, 96, n)
+        vels = rng.integers(40, 127, n)
+        ch = i % 16
+        events = [(0, b'\xff\x03' + varlen(len(b'Synth %d' % i)) + b'Synth %d' % i)]
+        for t, p, v in zip(ticks.tolist(), pitches.tolist(), vels.tolist()):
+            events.append((t, bytes((0x90 | ch, p, v))))
+            events.append((t + 60, bytes((0x90 | ch, p, 0))))
+        events.sort(key=lambda e: e[0])
+        chunks.append(track_chunk(events))
+    with open(path, 'wb') as f:
+        f.write(b'MThd' + (6).to_bytes(4, 'big') + (1).to_bytes(2, 'big') +
+                len(chunks).to_bytes(2, 'big') + tpb.to_bytes(2, 'big'))
+        for c in chunks:
+            f.write(c)
+    return path
+
+def timed(fn, repeat):
+    runs = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - t0)
+    return {'min': min(runs), 'median': float(np.median(runs))}
+
+def percentiles(samples):
+    a = np.array(samples) * 1000.0
+    if not len(a):
+        return {}
+    return {'mean_ms': float(a.mean()), 'p50_ms': float(np.percentile(a, 50)),
+            'p90_ms': float(np.percentile(a, 90)), 'p99_ms': float(np.percentile(a, 99)),
+            'max_ms': float(a.max()), 'frames': len(a)}
+
+def bench_parse(path, repeat):
+    main.analyze_midi(path)
+    return {'cold': timed(lambda: main.parse_midi(path), repeat),
+            'cached': timed(lambda: main.analyze_midi(path), repeat)}
+
+def bench_load(path, repeat):
+    tracks = main.analyze_midi(path)
+    main.load_notes(tracks, main.DEF_BPM)
+    return {'cold': timed(lambda: main.compile_chart(tracks, main.DEF_BPM), repeat),
+            'cached': timed(lambda: main.load_notes(tracks, main.DEF_BPM), repeat)}
+
+def bench_frame_fns(path, frames):
+    main.notes_queue = main.load_notes(main.analyze_midi(path), main.DEF_BPM)
+    main.note_idx = 0
+    t = main.notes_queue['t']
+    step = max(1, int(t[-1] * main.FPS) // frames) / main.FPS
+    upd = []
+    for k in range(frames):
+        main.game_time = k * step
+        t0 = time.perf_counter()
+        main.update_active_notes()
+        upd.append(time.perf_counter() - t0)
+    hit = []
+    for ti, lane in zip(t[:frames].tolist(), main.notes_queue['lane'][:frames].tolist()):
+        main.game_time = ti
+        t0 = time.perf_counter()
+        main.check_hit(lane)
+        hit.append(time.perf_counter() - t0)
+    return {'update_active_notes': percentiles(upd), 'check_hit': percentiles(hit)}
+
+def bench_sound(repeat):
+    keys = [(n, main.settings['wave'], main.VEL_LEVELS - 1) for n in range(128)]
+    return {'gen_sound': timed(lambda: main.gen_sound(440.0), repeat),
+            'render_128': timed(lambda: main.render_sounds(keys), repeat)}
+
+def player_script(path, frames, accuracy=0.9, extra=0.05, seed=0):
+    rng = np.random.default_rng(seed)
+    store = main.load_notes(main.analyze_midi(path), main.DEF_BPM)
+    script = {}
+    for ti, lane in zip(store['t'].tolist(), store['lane'].tolist()):
+        k = int(round(ti * main.FPS)) + (0 if rng.random() < accuracy else int(rng.integers(-6, 7)))
+        if 0 <= k < frames:
+            script.setdefault(k, []).append(pygame.event.Event(pygame.KEYDOWN, key=LANE_KEYS[lane]))
+    for k in rng.integers(0, frames, int(frames * extra)).tolist():
+        script.setdefault(k, []).append(pygame.event.Event(pygame.KEYDOWN, key=LANE_KEYS[int(rng.integers(main.LANES))]))
+    return script
+
+def bench_headless(path, frames):
+    ft = main.run_headless(path, player_script(path, frames), max_frames=frames)
+    out = percentiles(ft)
+    out.update(score=main.score, hits=main.hits, misses=main.misses)
+    return out
+
+def bench_replay(path):
+    res = main.run_replay(path)
+    if not res:
+        return {}
+    out = percentiles(res['frames'])
+    out.update(score=res['score'], hits=res['hits'], misses=res['misses'])
+    return out
+
+def flatten(d, prefix=''):
+    out = {}
+    for k, v in d.items():
+        if isinstance(v, dict):
+            out.update(flatten(v, prefix + k + '.'))
+        elif isinstance(v, float):
+            out[prefix + k] = v
+    return out
+
+def compare(results, base_path, tolerance):
+    with open(base_path) as f:
+        base = flatten(json.load(f)['results'])
+    cur = flatten(results)
+    bad = []
+    for k in sorted(set(base) & set(cur)):
+        if base[k] > 0 and cur[k] > base[k] * (1 + tolerance):
+            bad.append((k, base[k], cur[k]))
+            print("REGRESSION %s: %.6g -> %.6g (%+.0f%%)" % (k, base[k], cur[k], (cur[k] / base[k] - 1) * 100))
+    return bad
+
+def git_rev():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def run(args):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        main.CACHE_DIR = os.path.join(tmp, 'cache')
+        for size in args.sizes:
+            for dens in args.density:
+                name = "%s_%d" % (dens, size)
+                path = synth_midi(os.path.join(tmp, name + '.mid'), size, DENSITIES[dens])
+                res = results[name] = {}
+                if 'parse' in args.only:
+                    res['analyze_midi'] = bench_parse(path, args.repeat)
+                if 'load' in args.only:
+                    res['load_notes'] = bench_load(path, args.repeat)
+                if 'frame' in args.only:
+                    res.update(bench_frame_fns(path, args.frames))
+                if 'headless' in args.only:
+                    res['headless'] = bench_headless(path, args.frames)
+                print(name, "done", file=sys.stderr)
+        for path in args.replays:
+            results['replay_' + os.path.splitext(os.path.basename(path))[0]] = bench_replay(path)
+            print(path, "done", file=sys.stderr)
+        if 'sound' in args.only:
+            main.init_audio()
+            results['sound'] = bench_sound(args.repeat)
+    return results
+
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description="Rhythm Hero benchmarks")
+    ap.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    ap.add_argument('--density', nargs='+', default=['medium', 'dense'], choices=sorted(DENSITIES))
+    ap.add_argument('--only', nargs='+', default=['parse', 'load', 'frame', 'sound', 'headless'])
+    ap.add_argument('--repeat', type=int, default=5)
+    ap.add_argument('--frames', type=int, default=1800)
+    ap.add_argument('--replays', nargs='+', default=[])
+    ap.add_argument('--out')
+    ap.add_argument('--compare')
+    ap.add_argument('--tolerance', type=float, default=0.2)
+    return ap.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = {
+        'meta': {'commit': git_rev(), 'python': platform.python_version(), 'numpy': np.__version__,
+                 'pygame': pygame.version.ver, 'platform': platform.platform(), 'time': time.time()},
+        'results': run(args)
+    }
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+    if args.compare and compare(report['results'], args.compare, args.tolerance):
+        sys.exit(1)
@@ -1,4 +1,10 @@
-import pygame, sys, mido, os, numpy as np, threading, time
+import time
+BOOT_T0 = time.perf_counter()
+import pygame, sys, os, numpy as np, threading, hashlib, json, multiprocessing, platform, queue, shutil, struct
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+mido = None
 
 W, H, FPS = 1100, 700, 60
 LANES, LANE_W = 4, 1100 // 4
@@ -6,285 +12,1166 @@ HIT_Y, DEF_SPEED, DEF_BPM = H - 100, 300, 120
 
 KEYS = {pygame.K_q: 0, pygame.K_w: 1, pygame.K_e: 2, pygame.K_r: 3}
 KEY_NAMES = ['Q', 'W', 'E', 'R']
+JUDGE_COL = {'perfect': (120, 220, 255), 'great': (120, 255, 140), 'good': (255, 220, 100), 'miss': (255, 100, 100)}
 LANE_COL = [(255, 100, 100), (100, 255, 100), (100, 100, 255), (255, 255, 100)]
-MENU, TRACK_SEL, PLAYING, PAUSED, GAMEOVER = range(5)
+MENU, TRACK_SEL, PLAYING, PAUSED, GAMEOVER, CALIBRATE = range(6)
+TEXT_CACHE_MAX = 256
+PARSER_VERSION = 3
+DEF_TEMPO = 500000
+CACHE_DIR = "cache"
+LIBRARY_INDEX = os.path.join(CACHE_DIR, "library.json")
+CALIB_PATH = os.path.join(CACHE_DIR, "calibration.json")
+REPLAY_DIR = "replays"
+NOTE_DTYPE = np.dtype([('time', '<f8'), ('note', 'u1'), ('velocity', 'u1')])
+CHART_DTYPE = np.dtype([('t', '<f8'), ('lane', 'u1'), ('note', 'u1'), ('velocity', 'u1')])
+SAMPLE_RATE, MIX_BUFFER = 44100, 512
+SOUND_BANK_BYTES = 24 << 20
+VEL_LEVELS = 4
+WAVES = ('sine', 'square', 'triangle')
+PREVIEW_SECS, PREVIEW_CHUNK = 8, 0.25
+PREVIEW_VOICES, LANE_VOICES, UI_VOICES = 1, 6, 2
+SIM_HZ = 1000
+CALIB_BEAT, CALIB_TAPS, CALIB_WARMUP = 0.6, 8, 2
+JUDGE = (('perfect', 0.045, 100), ('great', 0.090, 70), ('good', 0.150, 40))
+PROF_FRAMES = 600
+STREAM_CHUNK, STREAM_AHEAD = 2.0, 8
+NOTE_H, LOD_NOTES = 18, 512
+REPLAY_MAGIC, REPLAY_HZ = b'RHRP', 10000
+REPLAY_HEAD = struct.Struct('<4sB20sHHBBff')
+MENU_ROWS, TRACK_ROWS = 5, 7
+SONG_ROW, TRACK_ROW = 55, 60
+LIST_KEYS = (pygame.K_UP, pygame.K_DOWN, pygame.K_PAGEUP, pygame.K_PAGEDOWN, pygame.K_HOME, pygame.K_END)
+PHASES = ('events', 'update', 'draw', 'audio', 'present')
+P_EVENTS, P_UPDATE, P_DRAW, P_AUDIO, P_PRESENT = range(len(PHASES))
 
-settings = {'speed': DEF_SPEED, 'bpm': DEF_BPM}
-hit_cache = {}
+settings = {'speed': DEF_SPEED, 'bpm': DEF_BPM, 'dirty_rects': True, 'wave': 'sine', 'vel_env': True, 'steal': 'oldest', 'lod': True}
+sound_bank = OrderedDict()
+bank_lock = threading.Lock()
+bank_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'rendered': 0, 'bytes': 0}
+bank_worker = None
+voices = {'pools': {}, 'meta': {}, 'stats': {'played': 0, 'stolen': 0, 'dropped': 0}}
 preview_active = False
+preview = {'thread': None, 'stop': None, 'seek': None, 'pos': 0.0, 'track': None}
+recording = {'meta': None, 'ticks': [], 'lanes': []}
+stream = {'queue': None, 'stop': None, 'thread': None, 'until': float('inf'), 'done': True}
 tracks_data = []
-notes_queue = []
+notes_queue = None
 note_idx = 0
 game_time = 0.0
 score = 0
 hits = 0
 misses = 0
 max_score = 0
-active_notes = []
+judgements = dict.fromkeys([j[0] for j in JUDGE] + ['miss'], 0)
+last_judge = None
+calibration = {'audio': 0.0, 'input': 0.0, 'measured': False}
+calib = {'phase': 'audio', 'start': 0.0, 'beat': -1, 'taps': [], 'result': {}, 'click': None}
+active_notes = np.empty(0, np.intp)
+active_y = np.empty(0)
+playfield = {'key': None}
+ui_cache = {'key': None, 'ui': [], 'hover': None, 'drawn': False}
+menu_list = {'query': '', 'view': [], 'scroll': 0.0, 'target': 0.0}
+track_list = {'scroll': 0.0, 'target': 0.0}
+song_index = {'songs': None, 'lower': [], 'memo': {}}
+font_cache = {}
+text_cache = OrderedDict()
+text_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+hash_memo = {}
+profiler = {
+    'on': os.environ.get('RH_PROFILE') == '1', 'overlay': False, 'frame': -1, 'mark': 0.0, 'seg': 0,
+    'phase': np.zeros((PROF_FRAMES, len(PHASES))), 'start': np.zeros(PROF_FRAMES), 'total': np.zeros(PROF_FRAMES),
+    'seg_t': np.zeros(PROF_FRAMES * 8), 'seg_d': np.zeros(PROF_FRAMES * 8), 'seg_p': np.zeros(PROF_FRAMES * 8, np.int8),
+    'surf': None, 'drawn_at': 0.0
+}
+startup = {'t0': BOOT_T0, 'marks': [], 'tasks': [], 'loader': None}
+mido_ready = threading.Event()
+
+def load_mido():
+    global mido
+    if mido_ready.is_set():
+        return
+    try:
+        import mido
+    except Exception as e:
+        print("MIDI module load error:", e)
+    mido_ready.set()
+    startup_mark('mido')
+
+def start_mido_loader():
+    if startup['loader'] is None and not mido_ready.is_set():
+        startup['loader'] = threading.Thread(target=load_mido, daemon=True)
+        startup['loader'].start()
+
+def need_mido():
+    if startup['loader'] is None:
+        load_mido()
+    mido_ready.wait()
+
+def startup_mark(name):
+    startup['marks'].append((name, time.perf_counter() - startup['t0']))
+
+def startup_report():
+    return " | ".join(name + " " + format(t * 1000, '.0f') + " ms" for name, t in startup['marks'])
+
+def startup_step():
+    name, fn = startup['tasks'].pop(0)
+    if fn is not None:
+        try:
+            fn()
+        except Exception as e:
+            print("Startup error:", name, e)
+    startup_mark(name)
+    if not startup['tasks'] and os.environ.get('RH_PROFILE') == '1':
+        print("Startup:", startup_report())
+library = {'files': {}, 'version': 0, 'pending': 0, 'lock': threading.Lock(), 'pool': None}
+
+def get_font(size):
+    f = font_cache.get(size)
+    if f is None:
+        f = font_cache[size] = pygame.font.Font(None, size)
+    return f
+
+def render_text(txt, size, col, aa=True):
+    key = (txt, size, col, aa)
+    surf = text_cache.get(key)
+    if surf is not None:
+        text_stats['hits'] += 1
+        text_cache.move_to_end(key)
+        return surf
+    text_stats['misses'] += 1
+    surf = get_font(size).render(txt, aa, col)
+    text_cache[key] = surf
+    if len(text_cache) > TEXT_CACHE_MAX:
+        text_cache.popitem(last=False)
+        text_stats['evictions'] += 1
+    return surf
+
+def text_cache_stats():
+    total = text_stats['hits'] + text_stats['misses']
+    return dict(text_stats, size=len(text_cache), fonts=len(font_cache),
+                hit_rate=text_stats['hits'] / total if total else 0.0)
 
 def midi_to_freq(n):
     return 440 * (2 ** ((n - 69) / 12))
 
 def init_audio():
     try:
-        pygame.mixer.pre_init(44100, -16, 2, 512)
+        pygame.mixer.pre_init(SAMPLE_RATE, -16, 2, MIX_BUFFER)
         pygame.init()
-        pygame.mixer.init(44100, -16, 2, 512)
+        pygame.mixer.init(SAMPLE_RATE, -16, 2, MIX_BUFFER)
+        init_voices()
         return True
     except Exception:
         pygame.init()
         return False
 
-def gen_sound(freq, dur=0.15, vol=0.4):
-    if freq <= 0:
-        freq = 440
-    sr = 44100
-    n = int(sr * dur)
-    t = np.linspace(0, dur, n, False)
-    wave = np.sin(2 * np.pi * freq * t)
+def init_voices():
+    sizes = [('preview', PREVIEW_VOICES)] + [(i, LANE_VOICES) for i in range(LANES)] + [('ui', UI_VOICES)]
+    total = sum(n for _, n in sizes)
+    pygame.mixer.set_num_channels(total)
+    pygame.mixer.set_reserved(total)
+    first = 0
+    for pool, n in sizes:
+        voices['pools'][pool] = [pygame.mixer.Channel(i) for i in range(first, first + n)]
+        first += n
+
+def voice_volume(note, vel):
+    if not settings['vel_env']:
+        return 1.0
+    level = (sound_key(note, vel)[2] + 1) / VEL_LEVELS
+    return min(1.0, int(vel) / 127 / level)
+
+def play_voice(snd, pool, vol=1.0):
+    chans = voices['pools'].get(pool)
+    stats = voices['stats']
+    if not chans or snd is None:
+        stats['dropped'] += 1
+        return None
+    now = time.perf_counter()
+    meta = voices['meta']
+    ch = None
+    for c in chans:
+        if not c.get_busy():
+            ch = c
+            break
+    if ch is None:
+        if settings['steal'] == 'none':
+            stats['dropped'] += 1
+            return None
+        if settings['steal'] == 'quietest':
+            def loudness(c):
+                start, v, length = meta.get(c, (now, 1.0, 1.0))
+                return v * max(0.0, 1 - (now - start) / length)
+            ch = min(chans, key=loudness)
+        else:
+            ch = min(chans, key=lambda c: meta.get(c, (now,))[0])
+        ch.stop()
+        stats['stolen'] += 1
+    ch.set_volume(vol)
+    ch.play(snd)
+    meta[ch] = (now, vol, snd.get_length() or 1.0)
+    stats['played'] += 1
+    return ch
+
+def voice_stats():
+    chans = [c for pool in voices['pools'].values() for c in pool]
+    return dict(voices['stats'], busy=sum(1 for c in chans if c.get_busy()), total=len(chans))
+
+def synth_waves(freqs, levels, wave='sine', dur=0.15, vol=0.4):
+    n = int(SAMPLE_RATE * dur)
+    t = np.arange(n) / SAMPLE_RATE
+    phase = np.where(freqs > 0, freqs, 440)[:, None] * t
+    if wave == 'square':
+        w = np.sign(np.sin(2 * np.pi * phase)) * 0.5
+    elif wave == 'triangle':
+        w = 2 * np.abs(2 * (phase - np.floor(phase + 0.5))) - 1
+    else:
+        w = np.sin(2 * np.pi * phase)
     env = np.ones(n)
     env[:int(n * 0.1)] = np.linspace(0, 1, int(n * 0.1))
     env[-int(n * 0.3):] = np.linspace(1, 0, int(n * 0.3))
-    audio = np.int16(wave * env * vol * 32767)
-    return pygame.sndarray.make_sound(np.column_stack((audio, audio)))
+    audio = (w * env * (levels[:, None] * vol * 32767)).astype(np.int16)
+    return np.repeat(audio[:, :, None], 2, axis=2)
 
-def get_sound(note):
-    if note not in hit_cache:
-        try:
-            hit_cache[note] = gen_sound(midi_to_freq(note))
-        except Exception:
-            return None
-        if len(hit_cache) > 50:
-            hit_cache.pop(next(iter(hit_cache)))
-    return hit_cache.get(note)
+def gen_sound(freq, dur=0.15, vol=0.4, wave='sine'):
+    return pygame.sndarray.make_sound(synth_waves(np.array([freq], float), np.ones(1), wave, dur, vol)[0])
+
+def sound_key(note, vel=127):
+    lvl = min(VEL_LEVELS - 1, int(vel) * VEL_LEVELS // 128) if settings['vel_env'] else VEL_LEVELS - 1
+    return (int(note), settings['wave'], lvl)
+
+def render_sounds(keys):
+    out = []
+    for wave in set(k[1] for k in keys):
+        group = [k for k in keys if k[1] == wave]
+        freqs = np.array([midi_to_freq(k[0]) for k in group])
+        levels = np.array([(k[2] + 1) / VEL_LEVELS for k in group])
+        for k, pcm in zip(group, synth_waves(freqs, levels, wave)):
+            out.append((k, pygame.sndarray.make_sound(pcm), pcm.nbytes))
+    return out
+
+def bank_put(items):
+    with bank_lock:
+        for key, snd, size in items:
+            if key in sound_bank:
+                continue
+            sound_bank[key] = (snd, size)
+            bank_stats['bytes'] += size
+            bank_stats['rendered'] += 1
+        while bank_stats['bytes'] > SOUND_BANK_BYTES and len(sound_bank) > 1:
+            bank_stats['bytes'] -= sound_bank.popitem(last=False)[1][1]
+            bank_stats['evictions'] += 1
+
+def get_sound(note, vel=127):
+    key = sound_key(note, vel)
+    with bank_lock:
+        entry = sound_bank.get(key)
+        if entry is not None:
+            sound_bank.move_to_end(key)
+            bank_stats['hits'] += 1
+            return entry[0]
+        bank_stats['misses'] += 1
+    try:
+        item = render_sounds([key])[0]
+    except Exception:
+        return None
+    bank_put([item])
+    return item[1]
+
+def bank_fill(keys):
+    with bank_lock:
+        missing = [k for k in keys if k not in sound_bank]
+    try:
+        for i in range(0, len(missing), 64):
+            bank_put(render_sounds(missing[i:i + 64]))
+    except Exception as e:
+        print("Sound bank error:", e)
 
-def preview_notes(notes, bpm_val):
+def warm_sound_bank(tracks, wait=False):
+    global bank_worker
+    codes = [t['notes']['note'].astype(np.int32) * 128 + t['notes']['velocity'] for t in tracks if len(t['notes'])]
+    pairs = np.unique(np.concatenate(codes)).tolist() if codes else []
+    keys = sorted(set(sound_key(c // 128, c % 128) for c in pairs))
+    if bank_worker is not None and bank_worker.is_alive():
+        bank_worker.join()
+    if wait:
+        bank_fill(keys)
+    else:
+        bank_worker = threading.Thread(target=bank_fill, args=(keys,), daemon=True)
+        bank_worker.start()
+
+def sound_bank_stats():
+    total = bank_stats['hits'] + bank_stats['misses']
+    return dict(bank_stats, size=len(sound_bank), hit_rate=bank_stats['hits'] / total if total else 0.0)
+
+def mix_preview(times, keys, pcm, s0, s1):
+    buf = np.zeros((s1 - s0, 2), np.float32)
+    tail = pcm.shape[1] / SAMPLE_RATE
+    lo = np.searchsorted(times, s0 / SAMPLE_RATE - tail, 'right')
+    hi = np.searchsorted(times, s1 / SAMPLE_RATE, 'left')
+    offs = np.rint(times[lo:hi] * SAMPLE_RATE).astype(np.int64) - s0
+    for off, k in zip(offs.tolist(), keys[lo:hi].tolist()):
+        a, b = max(off, 0), min(off + pcm.shape[1], len(buf))
+        if a < b:
+            buf[a:b] += pcm[k, a - off:b - off]
+    return np.ascontiguousarray(np.tanh(buf / 32767) * 32767, np.int16)
+
+def preview_worker(notes, bpm_val, stop):
+    global preview_active
+    order = np.argsort(notes['time'], kind='stable')
+    times = notes['time'][order] / (bpm_val / 120.0)
+    codes = notes['note'][order].astype(np.int32) * 128 + notes['velocity'][order]
+    uniq, inv = np.unique(codes, return_inverse=True)
+    slot = {}
+    code_key = np.array([slot.setdefault(sound_key(c // 128, c % 128), len(slot)) for c in uniq.tolist()], np.intp)
+    keys = code_key[inv]
+    skeys = list(slot)
+    freqs = np.array([midi_to_freq(k[0]) for k in skeys])
+    levels = np.array([(k[2] + 1) / VEL_LEVELS for k in skeys])
+    pcm = synth_waves(freqs, levels, settings['wave']).astype(np.float32)
+    last = int((times[-1] + pcm.shape[1] / SAMPLE_RATE) * SAMPLE_RATE) if len(times) else 0
+    step = int(PREVIEW_CHUNK * SAMPLE_RATE)
+    ch = voices['pools']['preview'][0]
+    pos = int(preview['pos'] * SAMPLE_RATE)
+    end = min(last, pos + PREVIEW_SECS * SAMPLE_RATE)
+    started = False
+    while not stop.is_set():
+        seek = preview['seek']
+        if seek is not None:
+            preview['seek'] = None
+            ch.stop()
+            pos = max(0, min(last, int(seek * SAMPLE_RATE)))
+            end = min(last, pos + PREVIEW_SECS * SAMPLE_RATE)
+            started = False
+        if pos >= end:
+            if not ch.get_busy():
+                break
+        elif not started or ch.get_queue() is None:
+            snd = pygame.sndarray.make_sound(mix_preview(times, keys, pcm, pos, min(pos + step, end)))
+            if started:
+                ch.queue(snd)
+                preview['pos'] = (pos - step) / SAMPLE_RATE
+            else:
+                ch.play(snd)
+                preview['pos'] = pos / SAMPLE_RATE
+                started = True
+            pos += step
+            continue
+        stop.wait(PREVIEW_CHUNK / 5)
+    if stop.is_set():
+        ch.stop()
+    elif preview['stop'] is stop:
+        preview_active = False
+
+def start_preview(track, bpm_val, start=0.0):
     global preview_active
+    stop_preview()
+    if 'preview' not in voices['pools']:
+        return
+    preview.update(stop=threading.Event(), seek=None, pos=start, track=track['idx'])
+    preview['thread'] = threading.Thread(target=preview_worker,
+                                         args=(track['notes'], bpm_val, preview['stop']), daemon=True)
     preview_active = True
-    mult = bpm_val / 120.0
-    start = time.time()
-    for n in sorted(notes, key=lambda x: x['time']):
-        if not preview_active:
-            break
-        wait = (n['time'] / mult) - (time.time() - start)
-        if wait > 0:
-            time.sleep(min(wait, 0.3))
-        s = get_sound(n['note'])
-        if s:
-            s.play()
-        if time.time() - start > 8:
-            break
+    preview['thread'].start()
+
+def stop_preview():
+    global preview_active
+    if preview['stop'] is not None:
+        preview['stop'].set()
+    if preview['thread'] is not None:
+        preview['thread'].join(0.5)
+    preview.update(thread=None, stop=None, track=None)
     preview_active = False
 
-def analyze_midi(path):
-    if not os.path.exists(path):
-        return []
+def seek_preview(delta):
+    if preview_active:
+        preview['seek'] = max(0.0, preview['pos'] + delta)
+
+def file_hash(path):
+    st = os.stat(path)
+    memo = (path, st.st_mtime_ns, st.st_size)
+    h = hash_memo.get(memo)
+    if h is None:
+        d = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                d.update(block)
+        h = hash_memo[memo] = d.hexdigest()
+    return h
+
+def cache_key(*parts):
+    return hashlib.sha1(repr((PARSER_VERSION,) + parts).encode()).hexdigest()
+
+def cache_path(key, ext):
+    return os.path.join(CACHE_DIR, 'charts', key + ext)
+
+def cache_save(key, arr, meta=None):
+    try:
+        os.makedirs(os.path.join(CACHE_DIR, 'charts'), exist_ok=True)
+        if meta is not None:
+            with open(cache_path(key, '.json.tmp'), 'w') as f:
+                json.dump(meta, f)
+            os.replace(cache_path(key, '.json.tmp'), cache_path(key, '.json'))
+        with open(cache_path(key, '.npy.tmp'), 'wb') as f:
+            np.save(f, np.ascontiguousarray(arr))
+        os.replace(cache_path(key, '.npy.tmp'), cache_path(key, '.npy'))
+    except Exception as e:
+        print("Chart cache write error:", e)
+
+def cache_writer(key):
+    try:
+        os.makedirs(os.path.join(CACHE_DIR, 'charts'), exist_ok=True)
+        return open(cache_path(key, '.raw.tmp'), 'wb')
+    except Exception as e:
+        print("Chart cache write error:", e)
+        return None
+
+def cache_finish(key, f, dtype, count):
+    try:
+        f.close()
+        header = {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (count,)}
+        with open(cache_path(key, '.npy.tmp'), 'wb') as out, open(cache_path(key, '.raw.tmp'), 'rb') as src:
+            np.lib.format.write_array_header_1_0(out, header)
+            shutil.copyfileobj(src, out, 1 << 20)
+        os.replace(cache_path(key, '.npy.tmp'), cache_path(key, '.npy'))
+        os.remove(cache_path(key, '.raw.tmp'))
+    except Exception as e:
+        print("Chart cache write error:", e)
+
+def cache_load(key, with_meta=False):
     try:
-        mid = mido.MidiFile(path)
+        arr = np.load(cache_path(key, '.npy'), mmap_mode='r')
+        if not with_meta:
+            return arr, None
+        with open(cache_path(key, '.json')) as f:
+            return arr, json.load(f)
     except Exception:
-        return []
-    result = []
+        return None, None
+
+def build_tempo_map(changes, tpb):
+    changes = sorted(changes, key=lambda c: c[0])
+    ticks, tempos = [0], [DEF_TEMPO]
+    for tick, tempo in changes:
+        if tick == ticks[-1]:
+            tempos[-1] = tempo
+        else:
+            ticks.append(tick)
+            tempos.append(tempo)
+    ticks = np.array(ticks, np.int64)
+    spt = np.array(tempos, np.float64) / (1e6 * tpb)
+    secs = np.concatenate(([0.0], np.cumsum(np.diff(ticks) * spt[:-1])))
+    return ticks, spt, secs
+
+def ticks_to_seconds(ticks, tmap):
+    m_ticks, spt, secs = tmap
+    k = np.searchsorted(m_ticks, ticks, 'right') - 1
+    return secs[k] + (ticks - m_ticks[k]) * spt[k]
+
+def parse_midi(path):
+    need_mido()
+    mid = mido.MidiFile(path)
+    tempos, tracks = [], []
     for i, tr in enumerate(mid.tracks):
-        notes = []
+        ticks, pitches, vels, changes = [], [], [], []
         abs_t = 0
-        tempo = 500000
         name = "Track " + str(i + 1)
         for msg in tr:
             abs_t += msg.time
             if msg.type == 'set_tempo':
-                tempo = msg.tempo
+                changes.append((abs_t, msg.tempo))
             if msg.type == 'track_name':
                 name = msg.name
             if msg.type == 'note_on' and msg.velocity > 0:
-                notes.append({
-                    'note': msg.note,
-                    'time': mido.tick2second(abs_t, mid.ticks_per_beat, tempo),
-                    'velocity': msg.velocity
-                })
-        if notes:
-            vals = [n['note'] for n in notes]
-            result.append({
-                'idx': i,
-                'name': name,
-                'notes': notes,
-                'count': len(notes),
-                'min': min(vals),
-                'max': max(vals),
-                'selected': True
-            })
+                ticks.append(abs_t)
+                pitches.append(msg.note)
+                vels.append(msg.velocity)
+        tempos.append(changes)
+        tracks.append((i, name, ticks, pitches, vels))
+    shared = None
+    if mid.type != 2:
+        shared = build_tempo_map([c for ch in tempos for c in ch], mid.ticks_per_beat)
+    meta, parts = [], []
+    start = 0
+    for i, name, ticks, pitches, vels in tracks:
+        if not ticks:
+            continue
+        tmap = shared or build_tempo_map(tempos[i], mid.ticks_per_beat)
+        arr = np.empty(len(ticks), NOTE_DTYPE)
+        arr['time'] = ticks_to_seconds(np.array(ticks, np.int64), tmap)
+        arr['note'] = pitches
+        arr['velocity'] = vels
+        meta.append({
+            'idx': i,
+            'name': name,
+            'start': start,
+            'count': len(arr),
+            'min': int(arr['note'].min()),
+            'max': int(arr['note'].max())
+        })
+        parts.append(arr)
+        start += len(arr)
+    return (np.concatenate(parts) if parts else np.empty(0, NOTE_DTYPE)), meta
+
+def analyze_midi(path):
+    if not os.path.exists(path):
+        return []
+    try:
+        key = cache_key('tracks', file_hash(path))
+    except Exception:
+        key = None
+    arr, meta = cache_load(key, True) if key else (None, None)
+    if arr is None or meta is None:
+        try:
+            arr, meta = parse_midi(path)
+        except Exception:
+            return []
+        if key and meta:
+            cache_save(key, arr, meta)
+            cached = cache_load(key)[0]
+            if cached is not None:
+                arr = cached
+    result = []
+    for m in meta:
+        result.append({
+            'idx': m['idx'],
+            'name': m['name'],
+            'notes': arr[m['start']:m['start'] + m['count']],
+            'count': m['count'],
+            'min': m['min'],
+            'max': m['max'],
+            'chart': key,
+            'song': path,
+            'selected': True
+        })
     return result
 
-def load_notes(tracks, bpm_val):
+def compile_notes(notes, mult, last):
+    t = notes['time'] * mult
+    order = np.argsort(t, kind='stable')
+    t = t[order]
+    pitch = notes['note'][order]
+    lane = pitch % LANES
+    keep = np.zeros(len(t), bool)
+    for ln in range(LANES):
+        idx = np.flatnonzero(lane == ln)
+        prev = last[ln]
+        for i, ti in zip(idx.tolist(), t[idx].tolist()):
+            if ti - prev > 0.05:
+                keep[i] = True
+                prev = ti
+        last[ln] = prev
+    chart = np.empty(int(keep.sum()), CHART_DTYPE)
+    chart['t'] = t[keep]
+    chart['lane'] = lane[keep]
+    chart['note'] = pitch[keep]
+    chart['velocity'] = notes['velocity'][order][keep]
+    return chart
+
+def compile_chart(tracks, bpm_val):
+    return compile_notes(np.concatenate([t['notes'] for t in tracks]), 120.0 / bpm_val, [-1000] * LANES)
+
+def chart_chunks(tracks, bpm_val, span):
     mult = 120.0 / bpm_val
-    all_n = []
-    for t in tracks:
-        if not t['selected']:
-            continue
-        for n in t['notes']:
-            all_n.append({
-                't': n['time'] * mult,
-                'lane': n['note'] % LANES,
-                'note': n['note'],
-                'hit': False
-            })
-    all_n.sort(key=lambda x: x['t'])
+    notes = [t['notes'] for t in tracks]
+    cur = [0] * len(notes)
     last = [-1000] * LANES
-    filtered = []
-    for n in all_n:
-        if n['t'] - last[n['lane']] > 0.05:
-            filtered.append(n)
-            last[n['lane']] = n['t']
-    return filtered
-
-def draw_btn(scr, txt, x, y, w, h, col, hcol, mpos, en=True):
-    rect = pygame.Rect(x, y, w, h)
-    hover = rect.collidepoint(mpos) if en else False
-    cur = hcol if hover and en else (col if en else (80, 80, 100))
-    pygame.draw.rect(scr, cur, rect, border_radius=8)
-    pygame.draw.rect(scr, (255, 255, 255) if en else (150, 150, 150), rect, 2, border_radius=8)
-    f = pygame.font.Font(None, 28)
-    t = f.render(txt, True, (255, 255, 255) if en else (180, 180, 180))
-    scr.blit(t, t.get_rect(center=rect.center))
-    return rect
-
-def draw_menu(scr, songs, sel, mpos):
-    scr.fill((18, 18, 38))
-    fl = pygame.font.Font(None, 72)
-    fm = pygame.font.Font(None, 38)
-    title = fl.render("RHYTHM HERO", True, (255, 255, 255))
-    scr.blit(title, (W // 2 - title.get_width() // 2, 150))
+    edge = 0.0
+    while any(c < len(n) for c, n in zip(cur, notes)):
+        edge += span
+        parts = []
+        for k, n in enumerate(notes):
+            hi = int(np.searchsorted(n['time'], edge / mult, 'left'))
+            parts.append(n[cur[k]:hi])
+            cur[k] = hi
+        yield compile_notes(np.concatenate(parts), mult, last), edge
+
+def chart_key(sel, bpm_val):
+    src = sel[0].get('chart')
+    return cache_key('chart', src, tuple(t['idx'] for t in sel), bpm_val, LANES) if src else None
+
+def load_notes(tracks, bpm_val):
+    sel = [t for t in tracks if t['selected']]
+    if not sel:
+        return []
+    key = chart_key(sel, bpm_val)
+    chart = cache_load(key)[0] if key else None
+    if chart is None:
+        chart = compile_chart(sel, bpm_val)
+        if key and len(chart):
+            cache_save(key, chart)
+    return make_note_store(chart) if len(chart) else None
+
+def make_note_store(chart, hit=None):
+    t = np.array(chart['t'], np.float64)
+    lane = np.array(chart['lane'], np.intp)
+    by_lane = [np.flatnonzero(lane == i) for i in range(LANES)]
+    return {
+        't': t,
+        'lane': lane,
+        'note': np.array(chart['note'], np.intp),
+        'velocity': np.array(chart['velocity'], np.intp),
+        'hit': np.zeros(len(t), bool) if hit is None else hit,
+        'lane_idx': by_lane,
+        'lane_t': [t[idx] for idx in by_lane]
+    }
+
+def stream_put(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def stream_worker(tracks, bpm_val, chart, key, q, stop):
+    out = None
+    try:
+        if chart is not None:
+            t = chart['t']
+            lo, edge = 0, 0.0
+            while lo < len(t):
+                edge += STREAM_CHUNK
+                hi = int(np.searchsorted(t, edge, 'left'))
+                if not stream_put(q, (np.array(chart[lo:hi]), edge), stop):
+                    return
+                lo = hi
+        else:
+            out = cache_writer(key) if key else None
+            count = 0
+            for chunk, edge in chart_chunks(tracks, bpm_val, STREAM_CHUNK):
+                if out:
+                    out.write(chunk.tobytes())
+                count += len(chunk)
+                if not stream_put(q, (chunk, edge), stop):
+                    return
+            if out and count:
+                cache_finish(key, out, CHART_DTYPE, count)
+                out = None
+    except Exception as e:
+        print("Chart stream error:", e)
+    finally:
+        if out:
+            out.close()
+            try:
+                os.remove(out.name)
+            except OSError:
+                pass
+        stream_put(q, None, stop)
+
+def stream_notes(tracks, bpm_val):
+    sel = [t for t in tracks if t['selected']]
+    if not sel:
+        return None
+    key = chart_key(sel, bpm_val)
+    chart = cache_load(key)[0] if key else None
+    stop_stream()
+    stream.update(queue=queue.Queue(STREAM_AHEAD), stop=threading.Event(), until=-1.0, done=False)
+    stream['thread'] = threading.Thread(target=stream_worker,
+                                        args=(sel, bpm_val, chart, key, stream['queue'], stream['stop']), daemon=True)
+    stream['thread'].start()
+    return make_note_store(np.empty(0, CHART_DTYPE))
+
+def stop_stream():
+    if stream['stop'] is not None:
+        stream['stop'].set()
+    if stream['thread'] is not None:
+        stream['thread'].join(0.5)
+    stream.update(queue=None, stop=None, thread=None, until=float('inf'), done=True)
+
+def feed_notes():
+    global notes_queue, note_idx, max_score
+    speed = settings['speed']
+    horizon = game_time + (HIT_Y + 60) / speed + STREAM_CHUNK
+    chunks = []
+    while not stream['done'] and stream['until'] < horizon:
+        item = stream['queue'].get()
+        if item is None:
+            stream['done'] = True
+        else:
+            chunks.append(item[0])
+            stream['until'] = item[1]
+    if not chunks:
+        return
+    store = notes_queue
+    drop = int(np.searchsorted(store['t'], game_time - (H + 60 - HIT_Y) / speed - JUDGE[-1][1] - 1.0, 'left'))
+    kept = np.empty(len(store['t']) - drop, CHART_DTYPE)
+    for f in CHART_DTYPE.names:
+        kept[f] = store[f][drop:]
+    chart = np.concatenate([kept] + chunks)
+    hit = np.zeros(len(chart), bool)
+    hit[:len(kept)] = store['hit'][drop:]
+    notes_queue = make_note_store(chart, hit)
+    note_idx = max(0, note_idx - drop)
+    max_score += (len(chart) - len(kept)) * 100
+
+def ui_text(txt, size, col, x=None, y=0, cx=None):
+    surf = render_text(txt, size, col)
+    rect = surf.get_rect(topleft=(x, y)) if cx is None else surf.get_rect(midtop=(cx, y))
+    return {'kind': 'text', 'surf': surf, 'rect': rect}
+
+def ui_box(rect, col, width=0, radius=0, wid=None):
+    return {'kind': 'box', 'id': wid, 'rect': pygame.Rect(rect), 'col': col, 'width': width, 'radius': radius}
+
+def ui_button(wid, txt, x, y, w, h, col, hcol, en=True):
+    return {'kind': 'button', 'id': wid, 'rect': pygame.Rect(x, y, w, h), 'en': en,
+            'col': col if en else (80, 80, 100), 'hcol': hcol,
+            'label': render_text(txt, 28, (255, 255, 255) if en else (180, 180, 180))}
+
+def render_ui(scr, ui, hover=None, only=None):
+    for w in ui:
+        if only is not None and w.get('id') not in only:
+            continue
+        scr.set_clip(w.get('clip'))
+        kind = w['kind']
+        if kind == 'fill':
+            scr.fill(w['col'])
+        elif kind == 'image':
+            scr.blit(w['surf'], (0, 0))
+        elif kind == 'text':
+            scr.blit(w['surf'], w['rect'])
+        elif kind == 'box':
+            pygame.draw.rect(scr, w['col'], w['rect'], w['width'], border_radius=w['radius'])
+            if w.get('dot'):
+                pygame.draw.circle(scr, (255, 255, 255), w['rect'].center, w['dot'])
+        elif kind == 'button':
+            rect = w['rect']
+            pygame.draw.rect(scr, w['hcol'] if w['id'] == hover else w['col'], rect, border_radius=8)
+            pygame.draw.rect(scr, (255, 255, 255) if w['en'] else (150, 150, 150), rect, 2, border_radius=8)
+            scr.blit(w['label'], w['label'].get_rect(center=rect.center))
+    scr.set_clip(None)
+
+def ui_rect(w):
+    return w['rect'].clip(w['clip']) if w.get('clip') else w['rect']
+
+def hit_test(ui, pos):
+    for w in reversed(ui):
+        if w.get('id') is not None and w.get('en', True) and ui_rect(w).collidepoint(pos):
+            return w['id']
+    return None
+
+def ui_clip(widgets, clip):
+    for w in widgets:
+        w['clip'] = clip
+    return widgets
+
+def ui_scrollbar(lst, x, y, h, count, rows, row_h):
+    if count <= rows:
+        return []
+    th = max(20, h * rows // count)
+    ty = y + int((h - th) * lst['scroll'] / ((count - rows) * row_h))
+    return [ui_box((x, y, 6, h), (40, 40, 70), radius=3), ui_box((x, ty, 6, th), (120, 120, 180), radius=3)]
+
+def list_window(lst, count, rows, row_h):
+    first = int(lst['scroll'] // row_h)
+    return first, min(count, first + rows + 1), first * row_h - int(lst['scroll'])
+
+def list_scroll(lst, delta, count, rows, row_h):
+    lst['target'] = max(0.0, min(lst['target'] + delta, float(max(0, count - rows) * row_h)))
+
+def list_follow(lst, k, rows, row_h):
+    if k * row_h < lst['target']:
+        lst['target'] = float(k * row_h)
+    elif (k + 1) * row_h > lst['target'] + rows * row_h:
+        lst['target'] = float((k + 1 - rows) * row_h)
+
+def list_move(key, k, count, page):
+    if key == pygame.K_HOME:
+        return 0
+    if key == pygame.K_END:
+        return max(0, count - 1)
+    step = {pygame.K_UP: -1, pygame.K_DOWN: 1, pygame.K_PAGEUP: -page, pygame.K_PAGEDOWN: page}[key]
+    return max(0, min(count - 1, k + step))
+
+def list_step(lst, dt):
+    d = lst['target'] - lst['scroll']
+    lst['scroll'] = lst['target'] if abs(d) < 0.5 else lst['scroll'] + d * min(1.0, dt * 15)
+
+def layout_menu(songs, sel):
+    ui = [{'kind': 'fill', 'col': (18, 18, 38)}, ui_text("RHYTHM HERO", 72, (255, 255, 255), cx=W // 2, y=150)]
     y = 250
     if not songs:
-        warn = fm.render("Put .mid files in 'songs/' folder", True, (255, 150, 150))
-        scr.blit(warn, (W // 2 - warn.get_width() // 2, y))
+        ui.append(ui_text("Put .mid files in 'songs/' folder", 38, (255, 150, 150), cx=W // 2, y=y))
         y += 50
-    select = fm.render("Select a song:", True, (200, 200, 220))
-    scr.blit(select, (W // 2 - select.get_width() // 2, y))
+    view, q = menu_list['view'], menu_list['query']
+    title = "Search: " + q + "_  (" + str(len(view)) + ")" if q else "Select a song:"
+    ui.append(ui_text(title, 38, (200, 200, 220), cx=W // 2, y=y))
     y += 50
-    rects = []
-    for i, s in enumerate(songs):
+    rows = min(len(songs), MENU_ROWS)
+    first, last, off = list_window(menu_list, len(view), MENU_ROWS, SONG_ROW)
+    clip = pygame.Rect(0, y, W, rows * SONG_ROW - 10)
+    for k in range(first, last):
+        i = view[k]
         c = (90, 90, 180) if i != sel else (130, 130, 240)
         hc = (130, 130, 240) if i != sel else (180, 180, 255)
-        name = s.replace('.mid', '')[:30]
-        rects.append((draw_btn(scr, name, W // 2 - 200, y + i * 55, 400, 45, c, hc, mpos), i))
-    en = len(songs) > 0
-    play = draw_btn(scr, "Next", W // 2 - 100, y + len(songs) * 55 + 40, 200, 50,
-                    (40, 180, 40) if en else (80, 100, 80),
-                    (60, 220, 60) if en else (100, 120, 100), mpos, en)
-    return rects, play
-
-def draw_track_sel(scr, tracks, mpos):
-    scr.fill((18, 18, 38))
-    fl = pygame.font.Font(None, 64)
-    fm = pygame.font.Font(None, 36)
-    fs = pygame.font.Font(None, 26)
-    title = fl.render("TRACK SELECTION", True, (255, 255, 255))
-    scr.blit(title, (W // 2 - title.get_width() // 2, 15))
+        b = ui_button(('song', i), songs[i].replace('.mid', '')[:30], W // 2 - 200, y + off + (k - first) * SONG_ROW,
+                      400, 45, c, hc)
+        ui.append(ui_clip([b], clip)[0])
+    ui += ui_scrollbar(menu_list, W // 2 + 212, y, rows * SONG_ROW - 10, len(view), MENU_ROWS, SONG_ROW)
+    en = sel >= 0
+    ui.append(ui_button('next', "Next", W // 2 - 100, y + rows * SONG_ROW + 40, 200, 50,
+                        (40, 180, 40) if en else (80, 100, 80), (60, 220, 60) if en else (100, 120, 100), en))
+    info = song_info(songs[sel]) if 0 <= sel < len(songs) else ""
+    if info:
+        ui.append(ui_text(info, 26, (180, 180, 200), cx=W // 2, y=y + rows * SONG_ROW + 100))
+    ui.append(ui_button('calibrate', "Calibrate", W - 170, H - 60, 150, 40, (90, 90, 120), (120, 120, 160)))
+    return ui
+
+def layout_track_sel(tracks):
+    ui = [{'kind': 'fill', 'col': (18, 18, 38)}, ui_text("TRACK SELECTION", 64, (255, 255, 255), cx=W // 2, y=15)]
     y0 = 85
-    t_rects = []
-    p_btns = []
-    visible = tracks[:7]
-    for i, tr in enumerate(visible):
-        y = y0 + i * 60
-        pygame.draw.rect(scr, (30, 30, 60) if tr['selected'] else (25, 25, 40),
-                        pygame.Rect(40, y, W - 220, 50), border_radius=8)
-        pygame.draw.rect(scr, (100, 100, 150) if tr['selected'] else (60, 60, 90),
-                        pygame.Rect(40, y, W - 220, 50), 2, border_radius=8)
-        cb = pygame.Rect(60, y + 10, 26, 26)
-        pygame.draw.rect(scr, (50, 200, 50) if tr['selected'] else (100, 100, 100), cb, border_radius=4)
-        if tr['selected']:
-            pygame.draw.circle(scr, (255, 255, 255), cb.center, 6)
-        scr.blit(fm.render(tr['name'], True, (255, 255, 255)), (100, y + 6))
+    rows = min(len(tracks), TRACK_ROWS)
+    first, last, off = list_window(track_list, len(tracks), TRACK_ROWS, TRACK_ROW)
+    clip = pygame.Rect(0, y0, W, rows * TRACK_ROW - 10)
+    for i in range(first, last):
+        tr = tracks[i]
+        y = y0 + off + (i - first) * TRACK_ROW
+        on = tr['selected']
+        cb = ui_box((60, y + 10, 26, 26), (50, 200, 50) if on else (100, 100, 100), radius=4, wid=('track', i))
+        row = [ui_box((40, y, W - 220, 50), (30, 30, 60) if on else (25, 25, 40), radius=8),
+               ui_box((40, y, W - 220, 50), (100, 100, 150) if on else (60, 60, 90), 2, 8), cb]
+        if on:
+            cb['dot'] = 6
+        row.append(ui_text(tr['name'], 36, (255, 255, 255), 100, y + 6))
         details = "Notes: " + str(tr['count']) + " | " + str(tr['min']) + "-" + str(tr['max'])
-        scr.blit(fs.render(details, True, (180, 180, 200)), (100, y + 28))
-        p_btns.append((draw_btn(scr, ">", W - 170, y + 7, 45, 35, (80, 80, 160), (120, 120, 220), mpos), i))
-        t_rects.append((cb, i))
-    sy = y0 + min(len(tracks), 7) * 60 + 15
-    pygame.draw.rect(scr, (25, 25, 50), pygame.Rect(40, sy, W - 80, 90), border_radius=10)
-    pygame.draw.rect(scr, (80, 80, 120), pygame.Rect(40, sy, W - 80, 90), 2, border_radius=10)
-    scr.blit(fs.render("SETTINGS", True, (200, 200, 220)), (60, sy + 8))
-    scr.blit(fs.render("Speed:", True, (180, 180, 200)), (60, sy + 35))
-    s_m = draw_btn(scr, "-", 200, sy + 30, 35, 30, (80, 80, 140), (120, 120, 200), mpos)
-    scr.blit(fm.render(str(settings['speed']), True, (255, 255, 255)), (245, sy + 32))
-    s_p = draw_btn(scr, "+", 290, sy + 30, 35, 30, (80, 80, 140), (120, 120, 200), mpos)
-    scr.blit(fs.render("BPM:", True, (180, 180, 200)), (350, sy + 35))
-    b_m = draw_btn(scr, "-", 480, sy + 30, 35, 30, (80, 80, 140), (120, 120, 200), mpos)
-    scr.blit(fm.render(str(settings['bpm']), True, (255, 255, 255)), (525, sy + 32))
-    b_p = draw_btn(scr, "+", 575, sy + 30, 35, 30, (80, 80, 140), (120, 120, 200), mpos)
+        row.append(ui_text(details, 26, (180, 180, 200), 100, y + 28))
+        row.append(ui_button(('preview', i), ">", W - 170, y + 7, 45, 35, (80, 80, 160), (120, 120, 220)))
+        ui += ui_clip(row, clip)
+    ui += ui_scrollbar(track_list, W - 112, y0, rows * TRACK_ROW - 10, len(tracks), TRACK_ROWS, TRACK_ROW)
+    sy = y0 + rows * TRACK_ROW + 15
+    ui.append(ui_box((40, sy, W - 80, 90), (25, 25, 50), radius=10))
+    ui.append(ui_box((40, sy, W - 80, 90), (80, 80, 120), 2, 10))
+    ui.append(ui_text("SETTINGS", 26, (200, 200, 220), 60, sy + 8))
+    ui.append(ui_text("Speed:", 26, (180, 180, 200), 60, sy + 35))
+    ui.append(ui_button('s_m', "-", 200, sy + 30, 35, 30, (80, 80, 140), (120, 120, 200)))
+    ui.append(ui_text(str(settings['speed']), 36, (255, 255, 255), 245, sy + 32))
+    ui.append(ui_button('s_p', "+", 290, sy + 30, 35, 30, (80, 80, 140), (120, 120, 200)))
+    ui.append(ui_text("BPM:", 26, (180, 180, 200), 350, sy + 35))
+    ui.append(ui_button('b_m', "-", 480, sy + 30, 35, 30, (80, 80, 140), (120, 120, 200)))
+    ui.append(ui_text(str(settings['bpm']), 36, (255, 255, 255), 525, sy + 32))
+    ui.append(ui_button('b_p', "+", 575, sy + 30, 35, 30, (80, 80, 140), (120, 120, 200)))
     by = sy + 100
-    sa = draw_btn(scr, "Select All", 100, by, 120, 38, (60, 100, 160), (80, 130, 200), mpos)
-    sd = draw_btn(scr, "Deselect All", 240, by, 120, 38, (100, 80, 80), (140, 100, 100), mpos)
+    ui.append(ui_button('sa', "Select All", 100, by, 120, 38, (60, 100, 160), (80, 130, 200)))
+    ui.append(ui_button('sd', "Deselect All", 240, by, 120, 38, (100, 80, 80), (140, 100, 100)))
     sel_c = sum(1 for t in tracks if t['selected'])
-    play_b = draw_btn(scr, "PLAY", W // 2 - 90, by, 180, 48,
-                      (40, 160, 40) if sel_c else (80, 100, 80),
-                      (60, 200, 60) if sel_c else (100, 120, 100), mpos, sel_c > 0)
-    back = draw_btn(scr, "Back", W // 2 - 70, by + 60, 140, 38, (100, 100, 100), (140, 140, 140), mpos)
+    ui.append(ui_button('play', "PLAY", W // 2 - 90, by, 180, 48, (40, 160, 40) if sel_c else (80, 100, 80),
+                        (60, 200, 60) if sel_c else (100, 120, 100), sel_c > 0))
+    ui.append(ui_button('back', "Back", W // 2 - 70, by + 60, 140, 38, (100, 100, 100), (140, 140, 140)))
     info = "Tracks: " + str(len(tracks)) + " | Selected: " + str(sel_c)
-    scr.blit(fs.render(info, True, (150, 150, 180)), (W // 2 - 80, by + 110))
-    return {
-        't_rects': t_rects, 'p_btns': p_btns, 's_m': s_m, 's_p': s_p,
-        'b_m': b_m, 'b_p': b_p, 'sa': sa, 'sd': sd, 'play': play_b, 'back': back
-    }
+    ui.append(ui_text(info, 26, (150, 150, 180), W // 2 - 80, by + 110))
+    return ui
+
+def get_playfield(scr):
+    key = (scr.get_size(), LANES)
+    if playfield['key'] != key:
+        bg = pygame.Surface(key[0]).convert()
+        bg.fill((0, 0, 0))
+        for i in range(LANES):
+            x = i * LANE_W
+            pygame.draw.line(bg, (60, 60, 80), (x, 0), (x, H), 2)
+            pygame.draw.rect(bg, (25, 25, 50), (x, HIT_Y, LANE_W, 100))
+            pygame.draw.rect(bg, (80, 80, 120), (x, HIT_Y, LANE_W, 100), 2)
+            txt = render_text(KEY_NAMES[i], 52, (220, 220, 255))
+            bg.blit(txt, txt.get_rect(center=(x + LANE_W // 2, HIT_Y + 50)))
+        hud = pygame.draw.rect(bg, (0, 0, 0, 180), (W // 2 - 60, 10, 120, 30))
+        hud.union_ip(bg.blit(render_text("P - Pause", 32, (200, 200, 255)), (W // 2 - 50, 15)))
+        nw = LANE_W - 24
+        atlas = pygame.Surface((nw * 2, NOTE_H * LANES)).convert()
+        atlas.fill((255, 0, 255))
+        atlas.set_colorkey((255, 0, 255), pygame.RLEACCEL)
+        sprites = []
+        for i in range(LANES):
+            for h, col in enumerate((LANE_COL[i], (150, 150, 150))):
+                sprites.append(pygame.draw.rect(atlas, col, (h * nw, i * NOTE_H, nw, NOTE_H), border_radius=4))
+        playfield.update(key=key, bg=bg, hud=hud, dirty=[], atlas=atlas, sprites=sprites)
+    return playfield
+
+def lod_runs(lanes, ys, kinds):
+    order = np.lexsort((ys, lanes))
+    lanes, ys, kinds = lanes[order], ys[order], kinds[order]
+    start = np.ones(len(ys), bool)
+    start[1:] = (lanes[1:] != lanes[:-1]) | (ys[1:] >= ys[:-1] + NOTE_H)
+    first = np.flatnonzero(start)
+    last = np.append(first[1:], len(ys)) - 1
+    spans = np.where(first == last, 0, ys[last] + NOTE_H - ys[first])
+    return lanes[first], ys[first], kinds[first], spans
 
-def draw_game(scr):
-    scr.fill((0, 0, 0))
-    for i in range(LANES):
-        x = i * LANE_W
-        pygame.draw.line(scr, (60, 60, 80), (x, 0), (x, H), 2)
-        pygame.draw.rect(scr, (25, 25, 50), (x, HIT_Y, LANE_W, 100))
-        pygame.draw.rect(scr, (80, 80, 120), (x, HIT_Y, LANE_W, 100), 2)
-        f = pygame.font.Font(None, 52)
-        txt = f.render(KEY_NAMES[i], True, (220, 220, 255))
-        scr.blit(txt, txt.get_rect(center=(x + LANE_W // 2, HIT_Y + 50)))
-    for lane, y, data in active_notes:
-        col = LANE_COL[lane] if not data['hit'] else (150, 150, 150)
-        pygame.draw.rect(scr, col, (lane * LANE_W + 12, y, LANE_W - 24, 18), border_radius=4)
-    f = pygame.font.Font(None, 32)
+def draw_game(scr, full=True):
+    pf = get_playfield(scr)
+    bg = pf['bg']
+    if full:
+        scr.blit(bg, (0, 0))
+    else:
+        scr.blits([(bg, r, r) for r in pf['dirty']], False)
+    rects = []
+    store = notes_queue
+    if store and len(active_notes):
+        lanes = store['lane'][active_notes]
+        ys = active_y.astype(np.intp)
+        kinds = lanes * 2 + store['hit'][active_notes]
+        if settings['lod'] and len(lanes) > LOD_NOTES:
+            lanes, ys, kinds, spans = lod_runs(lanes, ys, kinds)
+            for lane, y, span in zip(lanes[spans > 0].tolist(), ys[spans > 0].tolist(), spans[spans > 0].tolist()):
+                rects.append(scr.fill(LANE_COL[lane], (lane * LANE_W + 12, y, LANE_W - 24, span)))
+            single = spans == 0
+            lanes, ys, kinds = lanes[single], ys[single], kinds[single]
+        atlas, sprites = pf['atlas'], pf['sprites']
+        xs = (lanes * LANE_W + 12).tolist()
+        rects += scr.blits([(atlas, (x, y), sprites[k]) for x, y, k in zip(xs, ys.tolist(), kinds.tolist())])
     ui = "Score: " + str(score) + "  |  Hits: " + str(hits) + "  |  Miss: " + str(misses)
-    scr.blit(f.render(ui, True, (255, 255, 255)), (15, 12))
-    pygame.draw.rect(scr, (0, 0, 0, 180), (W // 2 - 60, 10, 120, 30))
-    scr.blit(f.render("P - Pause", True, (200, 200, 255)), (W // 2 - 50, 15))
+    rects.append(scr.blit(render_text(ui, 32, (255, 255, 255)), (15, 12)))
+    if last_judge and game_time - last_judge[1] < 0.5:
+        txt = render_text(last_judge[0].upper(), 40, JUDGE_COL[last_judge[0]])
+        rects.append(scr.blit(txt, txt.get_rect(center=(W // 2, HIT_Y - 40))))
+    scr.blit(bg, pf['hud'], pf['hud'])
+    prev = pf['dirty']
+    pf['dirty'] = rects
+    if full:
+        return None
+    return prev + rects
 
-def draw_pause(scr):
+def pause_background(scr):
+    bg = scr.copy()
     overlay = pygame.Surface((W, H), pygame.SRCALPHA)
     overlay.fill((0, 0, 30, 200))
-    scr.blit(overlay, (0, 0))
-    fl = pygame.font.Font(None, 64)
-    fm = pygame.font.Font(None, 36)
-    title = fl.render("PAUSED", True, (255, 255, 255))
-    scr.blit(title, (W // 2 - title.get_width() // 2, 150))
+    bg.blit(overlay, (0, 0))
+    return bg
+
+def layout_pause(bg):
+    ui = [{'kind': 'image', 'surf': bg}, ui_text("PAUSED", 64, (255, 255, 255), cx=W // 2, y=150)]
     y = 250
-    scr.blit(fm.render("Speed: " + str(settings['speed']), True, (200, 200, 220)), (W // 2 - 80, y))
-    sm = draw_btn(scr, "-", W // 2 - 120, y + 30, 40, 40, (80, 80, 140), (120, 120, 200), pygame.mouse.get_pos())
-    scr.blit(fm.render(str(settings['speed']), True, (255, 255, 255)), (W // 2 - 30, y + 35))
-    sp = draw_btn(scr, "+", W // 2 + 80, y + 30, 40, 40, (80, 80, 140), (120, 120, 200), pygame.mouse.get_pos())
-    scr.blit(fm.render("BPM: " + str(settings['bpm']), True, (200, 200, 220)), (W // 2 - 60, y + 90))
-    bm = draw_btn(scr, "-", W // 2 - 120, y + 120, 40, 40, (80, 80, 140), (120, 120, 200), pygame.mouse.get_pos())
-    scr.blit(fm.render(str(settings['bpm']), True, (255, 255, 255)), (W // 2 - 30, y + 125))
-    bp = draw_btn(scr, "+", W // 2 + 80, y + 120, 40, 40, (80, 80, 140), (120, 120, 200), pygame.mouse.get_pos())
-    resume = draw_btn(scr, "Resume", W // 2 - 100, y + 190, 200, 50, (40, 160, 40), (60, 200, 60), pygame.mouse.get_pos())
-    track_sel_b = draw_btn(scr, "Tracks", W // 2 - 100, y + 250, 200, 45, (100, 100, 180), (130, 130, 220), pygame.mouse.get_pos())
-    menu_b = draw_btn(scr, "Menu", W // 2 - 100, y + 305, 200, 45, (100, 100, 100), (140, 140, 140), pygame.mouse.get_pos())
-    return {
-        'sm': sm, 'sp': sp, 'bm': bm, 'bp': bp,
-        'resume': resume, 'tracks': track_sel_b, 'menu': menu_b
-    }
+    ui.append(ui_text("Speed: " + str(settings['speed']), 36, (200, 200, 220), W // 2 - 80, y))
+    ui.append(ui_button('sm', "-", W // 2 - 120, y + 30, 40, 40, (80, 80, 140), (120, 120, 200)))
+    ui.append(ui_text(str(settings['speed']), 36, (255, 255, 255), W // 2 - 30, y + 35))
+    ui.append(ui_button('sp', "+", W // 2 + 80, y + 30, 40, 40, (80, 80, 140), (120, 120, 200)))
+    ui.append(ui_text("BPM: " + str(settings['bpm']), 36, (200, 200, 220), W // 2 - 60, y + 90))
+    ui.append(ui_button('bm', "-", W // 2 - 120, y + 120, 40, 40, (80, 80, 140), (120, 120, 200)))
+    ui.append(ui_text(str(settings['bpm']), 36, (255, 255, 255), W // 2 - 30, y + 125))
+    ui.append(ui_button('bp', "+", W // 2 + 80, y + 120, 40, 40, (80, 80, 140), (120, 120, 200)))
+    ui.append(ui_button('resume', "Resume", W // 2 - 100, y + 190, 200, 50, (40, 160, 40), (60, 200, 60)))
+    ui.append(ui_button('tracks', "Tracks", W // 2 - 100, y + 250, 200, 45, (100, 100, 180), (130, 130, 220)))
+    ui.append(ui_button('menu', "Menu", W // 2 - 100, y + 305, 200, 45, (100, 100, 100), (140, 140, 140)))
+    return ui
 
-def draw_gameover(scr):
-    scr.fill((18, 18, 38))
-    fl = pygame.font.Font(None, 72)
-    fm = pygame.font.Font(None, 42)
-    title = fl.render("GAME OVER", True, (255, 255, 255))
-    scr.blit(title, (W // 2 - title.get_width() // 2, 150))
-    scr.blit(fm.render("Score: " + str(score), True, (255, 220, 100)), (W // 2 - 60, 250))
+def layout_gameover():
+    ui = [{'kind': 'fill', 'col': (18, 18, 38)}, ui_text("GAME OVER", 72, (255, 255, 255), cx=W // 2, y=150)]
+    ui.append(ui_text("Score: " + str(score), 42, (255, 220, 100), W // 2 - 60, 250))
     if max_score > 0:
         acc = min(100, int(score / max_score * 100))
-        scr.blit(fm.render("Accuracy: " + str(acc) + "%", True, (150, 200, 255)), (W // 2 - 90, 310))
-    stats = "Hits: " + str(hits) + "  |  Misses: " + str(misses)
-    scr.blit(fm.render(stats, True, (180, 180, 200)), (W // 2 - 150, 370))
-    scr.blit(fm.render("ENTER - menu  |  ESC - exit", True, (180, 180, 200)), (W // 2 - 140, 450))
-    menu_btn = draw_btn(scr, "Menu", W // 2 - 80, 500, 160, 45, (100, 100, 180), (130, 130, 220), pygame.mouse.get_pos())
-    return menu_btn
+        ui.append(ui_text("Accuracy: " + str(acc) + "%", 42, (150, 200, 255), W // 2 - 90, 310))
+    ui.append(ui_text("Hits: " + str(hits) + "  |  Misses: " + str(misses), 42, (180, 180, 200), W // 2 - 150, 370))
+    grades = "  ".join(k.capitalize() + ": " + str(v) for k, v in judgements.items() if k != 'miss')
+    ui.append(ui_text(grades, 30, (150, 150, 180), cx=W // 2, y=415))
+    ui.append(ui_text("ENTER - menu  |  ESC - exit", 42, (180, 180, 200), W // 2 - 140, 450))
+    ui.append(ui_button('menu', "Menu", W // 2 - 80, 500, 160, 45, (100, 100, 180), (130, 130, 220)))
+    return ui
+
+def screen_ui(st, songs, sel, tracks_ver, pause_bg, lib_ver):
+    if st == MENU:
+        key = (st, lib_ver, menu_list['query'], sel, int(menu_list['scroll']))
+    elif st == TRACK_SEL:
+        key = (st, tracks_ver, settings['speed'], settings['bpm'], int(track_list['scroll']))
+    elif st == PAUSED:
+        key = (st, id(pause_bg), settings['speed'], settings['bpm'])
+    elif st == GAMEOVER:
+        key = (st, score, hits, misses, tuple(judgements.values()))
+    else:
+        return []
+    if ui_cache['key'] != key:
+        if st == MENU:
+            ui = layout_menu(songs, sel)
+        elif st == TRACK_SEL:
+            ui = layout_track_sel(tracks_data)
+        elif st == PAUSED:
+            ui = layout_pause(pause_bg)
+        else:
+            ui = layout_gameover()
+        ui_cache.update(key=key, ui=ui, drawn=False)
+    return ui_cache['ui']
+
+def present_ui(scr, ui, hover, full):
+    if full or not ui_cache['drawn']:
+        render_ui(scr, ui, hover)
+        ui_cache.update(drawn=True, hover=hover)
+        return None
+    if hover == ui_cache['hover']:
+        return []
+    changed = {hover, ui_cache['hover']} - {None}
+    ui_cache['hover'] = hover
+    render_ui(scr, ui, hover, changed)
+    return [ui_rect(w) for w in ui if w.get('id') is not None and w['id'] in changed]
+
+def load_calibration():
+    try:
+        with open(CALIB_PATH) as f:
+            data = json.load(f).get(platform.node())
+        if data:
+            calibration.update(audio=float(data['audio']), input=float(data['input']), measured=True)
+    except Exception:
+        pass
+
+def save_calibration():
+    try:
+        with open(CALIB_PATH) as f:
+            data = json.load(f)
+    except Exception:
+        data = {}
+    data[platform.node()] = {'audio': calibration['audio'], 'input': calibration['input']}
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(CALIB_PATH + '.tmp', 'w') as f:
+            json.dump(data, f)
+        os.replace(CALIB_PATH + '.tmp', CALIB_PATH)
+    except Exception as e:
+        print("Calibration write error:", e)
+
+def start_calibration(now):
+    calib.update(phase='audio', start=now + CALIB_BEAT, beat=-1, taps=[], result={})
+    if calib['click'] is None:
+        try:
+            calib['click'] = gen_sound(1760, 0.04, 0.6, 'square')
+        except Exception:
+            pass
+
+def calib_update(now):
+    k = int((now - calib['start']) // CALIB_BEAT)
+    if calib['phase'] != 'done' and k != calib['beat']:
+        calib['beat'] = k
+        if calib['phase'] == 'audio' and k >= 0 and calib['click']:
+            play_voice(calib['click'], 'ui')
+
+def calib_tap(t):
+    if calib['phase'] == 'done':
+        return
+    rel = (t - calib['start']) / CALIB_BEAT
+    k = round(rel)
+    if k < CALIB_WARMUP:
+        return
+    calib['taps'].append((rel - k) * CALIB_BEAT)
+    if len(calib['taps']) < CALIB_TAPS:
+        return
+    calib['result'][calib['phase']] = float(np.median(calib['taps']))
+    calib['taps'] = []
+    if calib['phase'] == 'audio':
+        calib.update(phase='visual', start=t + CALIB_BEAT, beat=-1)
+    else:
+        calib['phase'] = 'done'
+
+def apply_calibration():
+    res = calib['result']
+    calibration.update(audio=max(0.0, res['audio'] - res['visual']), input=res['visual'], measured=True)
+    save_calibration()
+
+def draw_calibration(scr, now):
+    scr.fill((18, 18, 38))
+    title = render_text("CALIBRATION", 64, (255, 255, 255))
+    scr.blit(title, (W // 2 - title.get_width() // 2, 120))
+    phase = calib['phase']
+    if phase == 'done':
+        res = calib['result']
+        lines = ["Audio latency: " + str(int(round(max(0.0, res['audio'] - res['visual']) * 1000))) + " ms",
+                 "Input latency: " + str(int(round(res['visual'] * 1000))) + " ms",
+                 "ENTER - save  |  P - back"]
+    else:
+        lines = ["Tap SPACE on each click" if phase == 'audio' else "Tap SPACE when the box flashes",
+                 "Taps: " + str(len(calib['taps'])) + "/" + str(CALIB_TAPS) + "  |  P - back"]
+        flash = phase == 'visual' and now >= calib['start'] and (now - calib['start']) % CALIB_BEAT < 0.08
+        pygame.draw.rect(scr, (255, 255, 255) if flash else (50, 50, 80), (W // 2 - 60, 420, 120, 120), border_radius=12)
+    for i, ln in enumerate(lines):
+        txt = render_text(ln, 36, (200, 200, 220))
+        scr.blit(txt, (W // 2 - txt.get_width() // 2, 230 + i * 50))
+    cur = ("Saved: audio " + str(int(round(calibration['audio'] * 1000))) + " ms, input " +
+           str(int(round(calibration['input'] * 1000))) + " ms") if calibration['measured'] else "Not calibrated"
+    cur = render_text(cur, 26, (150, 150, 180))
+    scr.blit(cur, (W // 2 - cur.get_width() // 2, H - 60))
+
+def prof_begin(t):
+    p = profiler
+    p['frame'] += 1
+    row = p['frame'] % PROF_FRAMES
+    p['phase'][row] = 0
+    p['start'][row] = t
+    p['mark'] = t
+
+def prof_resume(t):
+    profiler['mark'] = t
+
+def prof_mark(phase):
+    p = profiler
+    now = time.perf_counter()
+    d = now - p['mark']
+    p['phase'][p['frame'] % PROF_FRAMES, phase] += d
+    i = p['seg'] % len(p['seg_t'])
+    p['seg_t'][i], p['seg_d'][i], p['seg_p'][i] = p['mark'], d, phase
+    p['seg'] += 1
+    p['mark'] = now
+
+def prof_end(t):
+    p = profiler
+    row = p['frame'] % PROF_FRAMES
+    p['total'][row] = t - p['start'][row]
+
+def prof_stats():
+    p = profiler
+    n = min(p['frame'], PROF_FRAMES)
+    if n <= 0:
+        return None
+    rows = (p['frame'] - 1 - np.arange(n)) % PROF_FRAMES
+    total = p['total'][rows] * 1000
+    return {
+        'p50': float(np.percentile(total, 50)),
+        'p99': float(np.percentile(total, 99)),
+        'max': float(total.max()),
+        'phases': dict(zip(PHASES, (p['phase'][rows].mean(axis=0) * 1000).tolist()))
+    }
+
+def draw_overlay(scr, fps):
+    p = profiler
+    now = time.perf_counter()
+    if p['surf'] is None or now - p['drawn_at'] > 0.25:
+        st = prof_stats()
+        lines = ["FPS " + str(round(fps, 1)) + " | notes " + str(len(active_notes))]
+        if st:
+            lines.append("frame p50 " + format(st['p50'], '.2f') + " p99 " + format(st['p99'], '.2f') +
+                         " max " + format(st['max'], '.2f') + " ms")
+            lines.append(" ".join(k + " " + format(v, '.2f') for k, v in st['phases'].items()))
+        tc, sb, vc = text_cache_stats(), sound_bank_stats(), voice_stats()
+        lines.append("text " + str(int(tc['hit_rate'] * 100)) + "% (" + str(tc['size']) + ") | sound " +
+                     str(int(sb['hit_rate'] * 100)) + "% (" + str(sb['size']) + ")")
+        lines.append("voices " + str(vc['busy']) + "/" + str(vc['total']) + " | stolen " + str(vc['stolen']) +
+                     " | dropped " + str(vc['dropped']))
+        f = get_font(22)
+        rendered = [f.render(ln, True, (200, 255, 200)) for ln in lines]
+        surf = pygame.Surface((max(r.get_width() for r in rendered) + 12, len(rendered) * 18 + 8))
+        surf.fill((10, 10, 10))
+        for i, r in enumerate(rendered):
+            surf.blit(r, (6, 4 + i * 18))
+        p['surf'], p['drawn_at'] = surf, now
+    return scr.blit(p['surf'], (W - p['surf'].get_width() - 8, 48))
+
+def export_trace(path=None):
+    p = profiler
+    if path is None:
+        path = os.path.join(CACHE_DIR, "trace-" + time.strftime("%Y%m%d-%H%M%S") + ".json")
+    events = []
+    n = min(p['frame'], PROF_FRAMES)
+    for row in ((p['frame'] - 1 - np.arange(n)) % PROF_FRAMES)[::-1].tolist():
+        events.append({'name': 'frame', 'ph': 'X', 'pid': 1, 'tid': 0,
+                       'ts': p['start'][row] * 1e6, 'dur': p['total'][row] * 1e6})
+    m = min(p['seg'], len(p['seg_t']))
+    for i in ((p['seg'] - 1 - np.arange(m)) % len(p['seg_t']))[::-1].tolist():
+        events.append({'name': PHASES[p['seg_p'][i]], 'ph': 'X', 'pid': 1, 'tid': 1,
+                       'ts': p['seg_t'][i] * 1e6, 'dur': p['seg_d'][i] * 1e6})
+    for name, t in startup['marks']:
+        events.append({'name': name, 'ph': 'i', 's': 'g', 'pid': 1, 'tid': 2, 'ts': (startup['t0'] + t) * 1e6})
+    try:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    except Exception as e:
+        print("Trace export error:", e)
+        return None
+    return path
 
 def get_midi_files(folder="songs"):
     if not os.path.exists(folder):
@@ -299,195 +1186,711 @@ def get_midi_files(folder="songs"):
     except Exception:
         return []
 
-def update_active_notes():
-    global note_idx, active_notes, game_time
-    speed = settings['speed']
-    new_active = []
-    for lane, old_y, data in active_notes:
-        time_diff = data['t'] - game_time
-        y = HIT_Y - (time_diff * speed)
-        if -60 < y < H + 60 and not data['hit']:
-            new_active.append((lane, y, data))
-    active_notes = new_active
-    while note_idx < len(notes_queue):
-        note = notes_queue[note_idx]
-        if note.get('hit', False):
-            note_idx += 1
+def index_song(path):
+    tracks = analyze_midi(path)
+    total = sum(t['count'] for t in tracks)
+    dur = max((float(t['notes']['time'].max()) for t in tracks), default=0.0)
+    return {
+        'tracks': [{k: t[k] for k in ('idx', 'name', 'count', 'min', 'max')} for t in tracks],
+        'notes': total,
+        'min': min((t['min'] for t in tracks), default=0),
+        'max': max((t['max'] for t in tracks), default=0),
+        'duration': dur,
+        'density': total / dur if dur > 0 else 0.0
+    }
+
+def load_library():
+    try:
+        with open(LIBRARY_INDEX) as f:
+            data = json.load(f)
+        if data.get('version') == PARSER_VERSION:
+            return data['files']
+    except Exception:
+        pass
+    return {}
+
+def save_library():
+    with library['lock']:
+        data = {'version': PARSER_VERSION, 'files': dict(library['files'])}
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(LIBRARY_INDEX + '.tmp', 'w') as f:
+            json.dump(data, f)
+        os.replace(LIBRARY_INDEX + '.tmp', LIBRARY_INDEX)
+    except Exception as e:
+        print("Library index write error:", e)
+
+def index_results(folder, names):
+    try:
+        pool = ProcessPoolExecutor(min(len(names), os.cpu_count() or 1),
+                                   mp_context=multiprocessing.get_context('spawn'))
+        library['pool'] = pool
+        futures = {pool.submit(index_song, os.path.join(folder, n)): n for n in names}
+    except Exception as e:
+        print("Indexing without worker pool:", e)
+        for n in names:
+            try:
+                yield n, index_song(os.path.join(folder, n))
+            except Exception:
+                yield n, None
+        return
+    try:
+        for fut in as_completed(futures):
+            try:
+                yield futures[fut], fut.result()
+            except Exception:
+                yield futures[fut], None
+    finally:
+        library['pool'] = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def scan_library(folder="songs"):
+    known = load_library()
+    entries, stale = {}, []
+    for name in get_midi_files(folder):
+        try:
+            st = os.stat(os.path.join(folder, name))
+        except OSError:
             continue
-        time_diff = note['t'] - game_time
-        y = HIT_Y - (time_diff * speed)
-        if y > H + 60:
-            note_idx += 1
-        elif y >= -60:
-            active_notes.append((note['lane'], y, note))
-            note_idx += 1
+        e = known.get(name)
+        if not e or e['meta'] is None or e['size'] != st.st_size or e['mtime'] != st.st_mtime_ns:
+            e = {'size': st.st_size, 'mtime': st.st_mtime_ns, 'meta': None}
+            stale.append(name)
+        entries[name] = e
+    with library['lock']:
+        library['files'] = entries
+        library['pending'] = len(stale)
+        library['version'] += 1
+    for i, (name, meta) in enumerate(index_results(folder, stale) if stale else ()):
+        with library['lock']:
+            entries[name]['meta'] = meta
+            library['pending'] -= 1
+            library['version'] += 1
+        if i % 50 == 49:
+            save_library()
+    save_library()
+
+def start_library_scan(folder="songs"):
+    threading.Thread(target=scan_library, args=(folder,), daemon=True).start()
+
+def stop_library_scan():
+    pool = library['pool']
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def library_songs():
+    with library['lock']:
+        return sorted(library['files'])
+
+def song_info(name):
+    e = library['files'].get(name)
+    if not e or e['meta'] is None:
+        return "Indexing..." if library['pending'] else ""
+    m = e['meta']
+    dur = int(m['duration'])
+    return ("Tracks: " + str(len(m['tracks'])) + " | Notes: " + str(m['notes']) + " | " +
+            str(m['min']) + "-" + str(m['max']) + " | " + str(dur // 60) + ":" + str(dur % 60).zfill(2) +
+            " | " + str(round(m['density'], 1)) + " n/s")
+
+def search_songs(songs, query):
+    if song_index['songs'] is not songs:
+        song_index.update(songs=songs, lower=[s.lower().replace('.mid', '') for s in songs],
+                          memo={'': list(range(len(songs)))})
+    q = query.lower()
+    memo = song_index['memo']
+    if q in memo:
+        return memo[q]
+    base = q[:-1]
+    while base not in memo:
+        base = base[:-1]
+    lower = song_index['lower']
+    prefix, sub, fuzzy = [], [], []
+    for i in memo[base]:
+        name = lower[i]
+        if name.startswith(q):
+            prefix.append(i)
+        elif q in name:
+            sub.append(i)
         else:
-            break
+            it = iter(name)
+            if all(c in it for c in q):
+                fuzzy.append(i)
+    memo[q] = prefix + sub + fuzzy
+    return memo[q]
 
-def check_hit(lane):
-    for i, (ln, y, data) in enumerate(active_notes):
-        if ln == lane and not data['hit'] and abs(y - HIT_Y) < 60:
-            data['hit'] = True
-            return True
-    return False
+def open_song(name):
+    global tracks_data
+    tracks_data = analyze_midi(os.path.join("songs", name))
+    if not tracks_data:
+        print("No notes in file")
+        return False
+    track_list.update(scroll=0.0, target=0.0)
+    warm_sound_bank(tracks_data)
+    return True
+
+def varint(n):
+    out = bytearray()
+    while n >= 0x80:
+        out.append(n & 0x7f | 0x80)
+        n >>= 7
+    out.append(n)
+    return out
+
+def read_varint(buf, pos):
+    n = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        shift += 7
+        if b < 0x80:
+            return n, pos
+
+def encode_replay(meta, ticks, lanes):
+    out = bytearray(REPLAY_HEAD.pack(REPLAY_MAGIC, 1, bytes.fromhex(meta['sha1']), meta['bpm'], meta['speed'],
+                                     meta['lanes'], meta['parser'], meta['input'], meta['audio']))
+    name = meta['song'].encode()
+    out += varint(len(name)) + name
+    out += varint(len(meta['tracks']))
+    for idx in meta['tracks']:
+        out += varint(idx)
+    out += varint(len(ticks))
+    prev = 0
+    for k, lane in zip(ticks, lanes):
+        d = k - prev
+        prev = k
+        out += varint((d * 2 if d >= 0 else -d * 2 - 1) * meta['lanes'] + lane)
+    for v in (meta['score'], meta['hits'], meta['misses']):
+        out += varint(v)
+    return bytes(out)
+
+def decode_replay(data):
+    magic, ver, sha, bpm, speed, lanes, parser, inp, aud = REPLAY_HEAD.unpack_from(data)
+    if magic != REPLAY_MAGIC or ver != 1:
+        raise ValueError("not a replay file")
+    pos = REPLAY_HEAD.size
+    n, pos = read_varint(data, pos)
+    song = data[pos:pos + n].decode()
+    pos += n
+    n, pos = read_varint(data, pos)
+    tracks = []
+    for _ in range(n):
+        idx, pos = read_varint(data, pos)
+        tracks.append(idx)
+    n, pos = read_varint(data, pos)
+    ticks, lane_list = [], []
+    k = 0
+    for _ in range(n):
+        v, pos = read_varint(data, pos)
+        z, lane = divmod(v, lanes)
+        k += z // 2 if z % 2 == 0 else -(z + 1) // 2
+        ticks.append(k)
+        lane_list.append(lane)
+    result = []
+    for _ in range(3):
+        v, pos = read_varint(data, pos)
+        result.append(v)
+    meta = {'song': song, 'sha1': sha.hex(), 'tracks': tracks, 'bpm': bpm, 'speed': speed, 'lanes': lanes,
+            'parser': parser, 'input': inp, 'audio': aud, 'score': result[0], 'hits': result[1], 'misses': result[2]}
+    return meta, ticks, lane_list
+
+def replay_meta(sel):
+    return {'song': os.path.basename(sel[0]['song']), 'sha1': file_hash(sel[0]['song']),
+            'tracks': [t['idx'] for t in sel], 'bpm': settings['bpm'], 'speed': settings['speed'], 'lanes': LANES,
+            'parser': PARSER_VERSION, 'input': calibration['input'], 'audio': calibration['audio']}
+
+def save_replay():
+    meta = recording['meta']
+    recording['meta'] = None
+    if meta is None or not recording['ticks']:
+        return None
+    meta = dict(meta, score=score, hits=hits, misses=misses)
+    try:
+        os.makedirs(REPLAY_DIR, exist_ok=True)
+        path = os.path.join(REPLAY_DIR, os.path.splitext(meta['song'])[0] + time.strftime("-%Y%m%d-%H%M%S.rhr"))
+        with open(path, 'wb') as f:
+            f.write(encode_replay(meta, recording['ticks'], recording['lanes']))
+        return path
+    except Exception as e:
+        print("Replay save error:", e)
+        return None
+
+def load_replay(path):
+    try:
+        with open(path, 'rb') as f:
+            return decode_replay(f.read())
+    except Exception as e:
+        print("Replay load error:", e)
+        return None
+
+def replay_tracks(meta):
+    path = os.path.join("songs", meta['song'])
+    try:
+        if file_hash(path) != meta['sha1']:
+            print("Replay error: chart changed:", meta['song'])
+            return None
+    except Exception as e:
+        print("Replay error:", e)
+        return None
+    if meta['parser'] != PARSER_VERSION or meta['lanes'] != LANES:
+        print("Replay warning: recorded with parser", meta['parser'], "and", meta['lanes'], "lanes")
+    tracks = analyze_midi(path)
+    for t in tracks:
+        t['selected'] = t['idx'] in meta['tracks']
+    return tracks
+
+def press_lane(lane, t):
+    global score, hits, misses, last_judge
+    k = round(t * REPLAY_HZ)
+    t = k / REPLAY_HZ
+    if recording['meta'] is not None:
+        recording['ticks'].append(k)
+        recording['lanes'].append(lane)
+    i = check_hit(lane, t)
+    if i is None:
+        score = max(0, score - 5)
+        misses += 1
+        judgements['miss'] += 1
+        last_judge = ('miss', game_time)
+        return None
+    grade, pts = judge(t - notes_queue['t'][i])
+    score += pts
+    hits += 1
+    judgements[grade] += 1
+    last_judge = (grade, game_time)
+    return i
+
+def reset_score():
+    global score, hits, misses, last_judge
+    score = 0
+    hits = 0
+    misses = 0
+    for k in judgements:
+        judgements[k] = 0
+    last_judge = None
+
+def score_replay(path):
+    global notes_queue, max_score
+    rep = load_replay(path)
+    tracks = replay_tracks(rep[0]) if rep else None
+    if not tracks:
+        return None
+    meta, ticks, lanes = rep
+    notes_queue = load_notes(tracks, meta['bpm'])
+    if not notes_queue:
+        return None
+    max_score = len(notes_queue['t']) * 100
+    reset_score()
+    for k, lane in zip(ticks, lanes):
+        press_lane(lane, k / REPLAY_HZ)
+    return {'score': score, 'hits': hits, 'misses': misses, 'judgements': dict(judgements), 'recorded': meta}
+
+def run_replay(path, realtime=False, screen=None):
+    global tracks_data
+    rep = load_replay(path)
+    tracks = replay_tracks(rep[0]) if rep else None
+    if not tracks:
+        return None
+    if screen is None:
+        os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+        os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+        init_audio()
+        screen = pygame.display.set_mode((W, H))
+    meta = rep[0]
+    saved = settings['speed'], settings['bpm']
+    settings.update(speed=meta['speed'], bpm=meta['bpm'])
+    tracks_data = tracks
+    try:
+        if not start_game(False):
+            return None
+        frames = run_loop(screen, None, None, None if realtime else 1.0 / FPS, PLAYING, GAMEOVER, rep[1:])
+    finally:
+        settings.update(speed=saved[0], bpm=saved[1])
+    return {'score': score, 'hits': hits, 'misses': misses, 'frames': frames, 'recorded': meta}
+
+def update_active_notes():
+    global note_idx, active_notes, active_y
+    store = notes_queue
+    speed = settings['speed']
+    t = store['t']
+    lo = np.searchsorted(t, game_time - (H + 60 - HIT_Y) / speed, 'right')
+    hi = np.searchsorted(t, game_time + (HIT_Y + 60) / speed, 'left')
+    note_idx = max(note_idx, hi)
+    y = HIT_Y - (t[lo:hi] - game_time) * speed
+    live = ~store['hit'][lo:hi]
+    active_notes = np.arange(lo, hi)[live]
+    active_y = y[live]
+
+def check_hit(lane, t=None):
+    store = notes_queue
+    if t is None:
+        t = game_time
+    idx, lt = store['lane_idx'][lane], store['lane_t'][lane]
+    win = JUDGE[-1][1]
+    j = np.searchsorted(lt, t - win, 'left')
+    while j < len(lt) and lt[j] <= t + win:
+        i = idx[j]
+        if not store['hit'][i]:
+            store['hit'][i] = True
+            return i
+        j += 1
+    return None
+
+def judge(delta):
+    for name, win, pts in JUDGE:
+        if abs(delta) <= win:
+            return name, pts
+    return 'miss', 0
+
+def event_time(event, base, lag):
+    ts = getattr(event, 'timestamp', None)
+    if ts is None:
+        return base
+    return base - min(max((pygame.time.get_ticks() - ts) / 1000.0, 0.0), lag)
 
 def safe_state_change(new_state):
     global state, game_time, note_idx, active_notes
     if new_state == MENU:
         game_time = 0.0
         note_idx = 0
-        active_notes = []
+        active_notes = np.empty(0, np.intp)
     return new_state
 
-def main():
-    global tracks_data, notes_queue, note_idx, game_time
-    global score, hits, misses, max_score, active_notes, preview_active, state
-    if not init_audio():
-        print("Warning: Running without audio")
-    try:
-        screen = pygame.display.set_mode((W, H), pygame.DOUBLEBUF)
-        pygame.display.set_caption("Rhythm Hero")
-    except Exception as e:
-        print("Error creating window:", e)
-        pygame.quit()
-        sys.exit(1)
-    clock = pygame.time.Clock()
+def start_game(record=True):
+    global notes_queue, note_idx, game_time, max_score, active_notes
+    stop_preview()
+    notes_queue = stream_notes(tracks_data, settings['bpm'])
+    if not notes_queue:
+        return False
+    note_idx = 0
+    game_time = 0.0
+    max_score = 0
+    feed_notes()
+    if stream['done'] and not len(notes_queue['t']):
+        return False
+    sel = [t for t in tracks_data if t['selected']]
+    warm_sound_bank(sel, True)
+    active_notes = np.empty(0, np.intp)
+    reset_score()
+    recording.update(meta=None, ticks=[], lanes=[])
+    if record:
+        try:
+            recording['meta'] = replay_meta(sel)
+        except Exception as e:
+            print("Replay record error:", e)
+    return True
 
-    songs = get_midi_files("songs")
-    sel_song = 0 if songs else -1
-    state = MENU
+def run_loop(screen, script=None, max_frames=None, fixed_dt=None, start=MENU, stop_at=None, replay=None):
+    global game_time, state, notes_queue
+    clock = pygame.time.Clock()
+    draw_clock = pygame.time.Clock()
+    songs = []
+    sel_song = -1
+    lib_seen = -1
+    state = start
+    drawn_state = None
+    tracks_ver = 0
+    pause_bg = None
+    frame_times = []
+    sim_acc = work = 0.0
+    anchor = None
+    last = next_draw = time.perf_counter()
+    frame_open = False
+    rp = 0
     running = True
     while running:
-        dt = clock.tick(FPS) / 1000.0
+        if fixed_dt is None:
+            clock.tick(SIM_HZ if state in (PLAYING, CALIBRATE) else FPS)
+            now = time.perf_counter()
+            dt, lag, last = now - last, now - last, now
+        else:
+            dt, lag = fixed_dt, 0.0
+        t0 = time.perf_counter()
+        draw_now = fixed_dt is not None or t0 >= next_draw
+        prof = profiler['on']
+        if prof:
+            if frame_open:
+                prof_resume(t0)
+            else:
+                prof_begin(t0)
+                frame_open = True
+        if script and draw_now:
+            for ev in script.get(len(frame_times), ()):
+                pygame.event.post(ev)
         mpos = pygame.mouse.get_pos()
+        if library['version'] != lib_seen:
+            lib_seen = library['version']
+            cur = songs[sel_song] if 0 <= sel_song < len(songs) else None
+            songs = library_songs() or sorted(get_midi_files("songs"))
+            view = menu_list['view'] = search_songs(songs, menu_list['query'])
+            sel_song = songs.index(cur) if cur in songs else -1
+            if sel_song not in view:
+                sel_song = view[0] if view else -1
+        ev_base = game_time + sim_acc + lag
+        presses = []
+        if replay and state == PLAYING:
+            ticks, lanes = replay
+            while rp < len(ticks) and ticks[rp] <= ev_base * REPLAY_HZ:
+                presses.append((lanes[rp], ticks[rp] / REPLAY_HZ))
+                rp += 1
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 running = False
+            if event.type in (pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED):
+                ui_cache['drawn'] = False
+            if event.type == pygame.MOUSEWHEEL:
+                if state == MENU:
+                    list_scroll(menu_list, -event.y * SONG_ROW, len(menu_list['view']), MENU_ROWS, SONG_ROW)
+                elif state == TRACK_SEL:
+                    list_scroll(track_list, -event.y * TRACK_ROW, len(tracks_data), TRACK_ROWS, TRACK_ROW)
             if event.type == pygame.KEYDOWN:
                 if event.key == pygame.K_ESCAPE:
                     running = False
+                if event.key == pygame.K_F3:
+                    profiler['overlay'] = not profiler['overlay']
+                    profiler['on'] = profiler['overlay'] or os.environ.get('RH_PROFILE') == '1'
+                    ui_cache['drawn'] = False
+                if event.key == pygame.K_F4 and profiler['frame'] > 0:
+                    print("Trace written to", export_trace())
+                if state == MENU:
+                    view = menu_list['view']
+                    k = view.index(sel_song) if sel_song in view else -1
+                    if event.key in LIST_KEYS:
+                        k = list_move(event.key, k, len(view), MENU_ROWS)
+                    elif event.key == pygame.K_RETURN:
+                        if sel_song >= 0 and open_song(songs[sel_song]):
+                            tracks_ver += 1
+                            state = TRACK_SEL
+                    elif event.key == pygame.K_BACKSPACE or (event.unicode and event.unicode.isprintable()):
+                        q = menu_list['query']
+                        q = q[:-1] if event.key == pygame.K_BACKSPACE else q + event.unicode
+                        view = menu_list['view'] = search_songs(songs, q)
+                        menu_list.update(query=q, target=0.0)
+                        k = view.index(sel_song) if sel_song in view else 0
+                    if state == MENU and view:
+                        sel_song = view[k]
+                        list_follow(menu_list, k, MENU_ROWS, SONG_ROW)
+                    elif state == MENU:
+                        sel_song = -1
+                if state == TRACK_SEL and event.key in LIST_KEYS:
+                    top = list_move(event.key, int(track_list['target'] // TRACK_ROW),
+                                    len(tracks_data) - TRACK_ROWS + 1, TRACK_ROWS)
+                    track_list['target'] = 0.0
+                    list_scroll(track_list, top * TRACK_ROW, len(tracks_data), TRACK_ROWS, TRACK_ROW)
                 if event.key == pygame.K_p:
                     if state == PLAYING:
+                        pause_bg = pause_background(screen)
                         state = PAUSED
                     elif state == PAUSED:
                         state = PLAYING
-                    elif state == TRACK_SEL:
+                    elif state in (TRACK_SEL, CALIBRATE):
                         state = MENU
+                if state == TRACK_SEL and event.key in (pygame.K_LEFT, pygame.K_RIGHT):
+                    seek_preview(-2.0 if event.key == pygame.K_LEFT else 2.0)
                 if state == GAMEOVER and event.key == pygame.K_RETURN:
                     state = MENU
-                if state == PLAYING and event.key in KEYS:
-                    if check_hit(KEYS[event.key]):
-                        score += 100
-                        hits += 1
-                        for ln, y, data in active_notes:
-                            if ln == KEYS[event.key] and data['hit']:
-                                s = get_sound(data['note'])
-                                if s:
-                                    s.play()
-                                break
-                    else:
-                        score = max(0, score - 5)
-                        misses += 1
+                if state == CALIBRATE:
+                    if event.key == pygame.K_SPACE:
+                        calib_tap(event_time(event, t0, lag))
+                    elif event.key == pygame.K_RETURN and calib['phase'] == 'done':
+                        apply_calibration()
+                        state = MENU
+                if state == PLAYING and event.key in KEYS and replay is None:
+                    presses.append((KEYS[event.key], event_time(event, ev_base, lag) - calibration['input']))
             if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+                mpos = event.pos
                 try:
+                    wid = hit_test(screen_ui(state, songs, sel_song, tracks_ver, pause_bg, lib_seen), mpos)
                     if state == MENU:
-                        s_rects, play_r = draw_menu(screen, songs, sel_song, mpos)
-                        for r, i in s_rects:
-                            if r.collidepoint(mpos):
-                                sel_song = i
-                        if play_r.collidepoint(mpos) and sel_song >= 0:
-                            path = os.path.join("songs", songs[sel_song])
-                            tracks_data = analyze_midi(path)
-                            if tracks_data:
-                                state = TRACK_SEL
-                            else:
-                                print("No notes in file")
+                        if wid == 'calibrate':
+                            start_calibration(t0)
+                            state = CALIBRATE
+                        elif isinstance(wid, tuple):
+                            sel_song = wid[1]
+                        elif wid == 'next' and sel_song >= 0 and open_song(songs[sel_song]):
+                            tracks_ver += 1
+                            state = TRACK_SEL
                     elif state == TRACK_SEL:
-                        ui = draw_track_sel(screen, tracks_data, mpos)
-                        for cb, i in ui['t_rects']:
-                            if cb.collidepoint(mpos):
-                                tracks_data[i]['selected'] = not tracks_data[i]['selected']
-                        for pb, i in ui['p_btns']:
-                            if pb.collidepoint(mpos) and not preview_active:
-                                thread = threading.Thread(target=preview_notes,
-                                                        args=(tracks_data[i]['notes'], settings['bpm']),
-                                                        daemon=True)
-                                thread.start()
-                        if ui['s_m'].collidepoint(mpos):
+                        if isinstance(wid, tuple) and wid[0] == 'track':
+                            tracks_data[wid[1]]['selected'] = not tracks_data[wid[1]]['selected']
+                            tracks_ver += 1
+                        elif isinstance(wid, tuple):
+                            tr = tracks_data[wid[1]]
+                            if preview_active and preview['track'] == tr['idx']:
+                                stop_preview()
+                            else:
+                                start_preview(tr, settings['bpm'])
+                        elif wid == 's_m':
                             settings['speed'] = max(100, settings['speed'] - 50)
-                        if ui['s_p'].collidepoint(mpos):
+                        elif wid == 's_p':
                             settings['speed'] = min(700, settings['speed'] + 50)
-                        if ui['b_m'].collidepoint(mpos):
+                        elif wid == 'b_m':
                             settings['bpm'] = max(60, settings['bpm'] - 10)
-                        if ui['b_p'].collidepoint(mpos):
+                        elif wid == 'b_p':
                             settings['bpm'] = min(300, settings['bpm'] + 10)
-                        if ui['sa'].collidepoint(mpos):
+                        elif wid in ('sa', 'sd'):
                             for t in tracks_data:
-                                t['selected'] = True
-                        if ui['sd'].collidepoint(mpos):
-                            for t in tracks_data:
-                                t['selected'] = False
-                        if ui['play'].collidepoint(mpos) and any(t['selected'] for t in tracks_data):
-                            notes_queue = load_notes(tracks_data, settings['bpm'])
-                            if notes_queue:
-                                note_idx = 0
-                                game_time = 0.0
-                                score = 0
-                                hits = 0
-                                misses = 0
-                                max_score = len(notes_queue) * 100
-                                active_notes = []
+                                t['selected'] = wid == 'sa'
+                            tracks_ver += 1
+                        elif wid == 'play':
+                            if start_game():
                                 state = PLAYING
-                        if ui['back'].collidepoint(mpos):
+                        elif wid == 'back':
                             state = MENU
                     elif state == PAUSED:
-                        ui = draw_pause(screen)
-                        if ui['sm'].collidepoint(mpos):
+                        if wid == 'sm':
                             settings['speed'] = max(150, settings['speed'] - 50)
-                        if ui['sp'].collidepoint(mpos):
+                        elif wid == 'sp':
                             settings['speed'] = min(700, settings['speed'] + 50)
-                        if ui['bm'].collidepoint(mpos):
+                        elif wid == 'bm':
                             settings['bpm'] = max(60, settings['bpm'] - 10)
-                        if ui['bp'].collidepoint(mpos):
+                        elif wid == 'bp':
                             settings['bpm'] = min(200, settings['bpm'] + 10)
-                        if ui['resume'].collidepoint(mpos):
+                        elif wid == 'resume':
                             state = PLAYING
-                        if ui['tracks'].collidepoint(mpos):
+                        elif wid == 'tracks':
                             state = TRACK_SEL
-                        if ui['menu'].collidepoint(mpos):
+                        elif wid == 'menu':
                             state = MENU
                     elif state == GAMEOVER:
-                        menu_btn = draw_gameover(screen)
-                        if menu_btn.collidepoint(mpos):
+                        if wid == 'menu':
                             state = MENU
                 except Exception as e:
                     print("Mouse event error:", e)
-        try:
-            if state == MENU:
-                draw_menu(screen, songs, sel_song, mpos)
+        for lane, t in presses:
+            i = press_lane(lane, t)
+            if i is not None:
+                note, vel = notes_queue['note'][i], notes_queue['velocity'][i]
+                s = get_sound(note, vel)
+                if prof:
+                    prof_mark(P_EVENTS)
+                play_voice(s, lane, voice_volume(note, vel))
+                if prof:
+                    prof_mark(P_AUDIO)
+        if prof:
+            prof_mark(P_EVENTS)
+        if state == PLAYING:
+            if fixed_dt is not None:
+                target = game_time + sim_acc + dt
+            else:
+                if anchor is None:
+                    anchor = t0 - game_time - sim_acc
+                target = t0 - anchor
+            steps = int((target - game_time) * SIM_HZ)
+            game_time += steps / SIM_HZ
+            sim_acc = target - game_time
+        else:
+            sim_acc = 0.0
+            anchor = None
+            if state == CALIBRATE:
+                calib_update(t0)
+            elif state == MENU:
+                list_step(menu_list, dt)
             elif state == TRACK_SEL:
-                draw_track_sel(screen, tracks_data, mpos)
+                list_step(track_list, dt)
+        if not draw_now:
+            work += time.perf_counter() - t0
+            continue
+        next_draw = max(next_draw + 1.0 / FPS, t0)
+        dirty = None
+        try:
+            if state in (MENU, TRACK_SEL, PAUSED, GAMEOVER):
+                ui = screen_ui(state, songs, sel_song, tracks_ver, pause_bg, lib_seen)
+                dirty = present_ui(screen, ui, hit_test(ui, mpos), state != drawn_state or profiler['overlay'])
             elif state == PLAYING:
-                game_time += dt
+                feed_notes()
                 update_active_notes()
-                draw_game(screen)
-                if notes_queue and note_idx >= len(notes_queue) and not active_notes:
+                if prof:
+                    prof_mark(P_UPDATE)
+                dirty = draw_game(screen, state != drawn_state or not settings['dirty_rects'])
+                if stream['done'] and note_idx >= len(notes_queue['t']) and not len(active_notes):
                     state = GAMEOVER
-            elif state == PAUSED:
-                draw_pause(screen)
-            elif state == GAMEOVER:
-                draw_gameover(screen)
+            elif state == CALIBRATE:
+                draw_calibration(screen, t0)
+            if profiler['overlay']:
+                r = draw_overlay(screen, draw_clock.get_fps())
+                if dirty is not None:
+                    dirty.append(r)
+                    playfield['dirty'].append(r)
         except Exception as e:
             print("Draw error:", e)
-        pygame.display.flip()
+        if prof:
+            prof_mark(P_DRAW)
+        if dirty is None:
+            pygame.display.flip()
+        elif dirty:
+            pygame.display.update(dirty)
+        draw_clock.tick()
+        if prof:
+            prof_mark(P_PRESENT)
+            prof_end(time.perf_counter())
+        if startup['tasks']:
+            startup_step()
+        frame_open = False
+        drawn_state = state
+        frame_times.append(work + time.perf_counter() - t0)
+        work = 0.0
+        if state != TRACK_SEL and preview_active:
+            stop_preview()
+        if state not in (PLAYING, PAUSED):
+            if recording['meta'] is not None:
+                save_replay()
+            if notes_queue is not None:
+                stop_stream()
+                notes_queue = None
+        if state == stop_at or (max_frames is not None and len(frame_times) >= max_frames):
+            running = False
+    save_replay()
+    return frame_times
 
-    preview_active = False
+def run_headless(path, script=None, selected=None, max_frames=None):
+    global tracks_data
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+    init_audio()
+    screen = pygame.display.set_mode((W, H))
+    tracks_data = analyze_midi(path)
+    for t in tracks_data:
+        t['selected'] = selected is None or t['idx'] in selected
+    if not tracks_data or not start_game(False):
+        return []
+    return run_loop(screen, script, max_frames, 1.0 / FPS, PLAYING, GAMEOVER)
+
+def init_audio_task():
+    if not init_audio():
+        print("Warning: Running without audio")
+
+def main(replay_path=None):
+    startup_mark('imports')
+    try:
+        pygame.display.init()
+        pygame.font.init()
+        screen = pygame.display.set_mode((W, H), pygame.DOUBLEBUF)
+        pygame.display.set_caption("Rhythm Hero")
+    except Exception as e:
+        print("Error creating window:", e)
+        pygame.quit()
+        sys.exit(1)
+    startup_mark('window')
+    startup['tasks'] = [('first_frame', None), ('loader', start_mido_loader), ('audio', init_audio_task),
+                        ('calibration', load_calibration), ('library', lambda: start_library_scan("songs"))]
+    if replay_path:
+        while startup['tasks']:
+            startup_step()
+    played = replay_path and run_replay(replay_path, True, screen)
+    if not played:
+        run_loop(screen)
+    elif state == GAMEOVER:
+        run_loop(screen, start=GAMEOVER)
+    stop_preview()
+    stop_stream()
+    stop_library_scan()
     pygame.quit()
     sys.exit(0)
 
 if __name__ == "__main__":
     try:
-        main()
+        main(sys.argv[1] if len(sys.argv) > 1 else None)
     except KeyboardInterrupt:
         print("\nExiting...")
         pygame.quit()